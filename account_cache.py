@@ -0,0 +1,117 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+from pymongo.errors import OperationFailure, PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+
+class AccountCache:
+    """Bounded LRU cache of user documents with a TTL per entry.
+
+    Reads go to MongoDB only on a miss. Balance-changing writes push their result in
+    with `put`. `watch` refreshes cached entries that other bot processes change, and
+    ignores updates that only touch fields the projection excludes.
+    """
+
+    def __init__(self, users, max_size=10000, ttl=60, projection=None):
+        self.users = users
+        self.max_size = max_size
+        self.ttl = ttl
+        self.projection = projection
+        self.entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+        self.refreshes = 0
+        self.excluded_fields = [field for field, spec in (projection or {}).items() if not spec]
+        self.watch_task = None
+
+    async def get(self, chat_id):
+        entry = self.entries.get(chat_id)
+        if entry is not None:
+            account, expires_at = entry
+            if expires_at > time.monotonic():
+                self.entries.move_to_end(chat_id)
+                self.hits += 1
+                return account
+            del self.entries[chat_id]
+
+        self.misses += 1
+        account = await self.users.find_one({'_id': chat_id}, self.projection)
+        if account is not None:
+            self.put(chat_id, account)
+        return account
+
+    def put(self, chat_id, account):
+        self.entries[chat_id] = (account, time.monotonic() + self.ttl)
+        self.entries.move_to_end(chat_id)
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+            self.evictions += 1
+
+    def invalidate(self, chat_id):
+        if self.entries.pop(chat_id, None) is not None:
+            self.invalidations += 1
+
+    def start_watching(self):
+        self.watch_task = asyncio.create_task(self.watch())
+
+    async def watch(self):
+        # Field paths like 'audit_outbox.3' count as their top-level field
+        changed_fields = {'$concatArrays': [
+            {'$map': {'input': {'$objectToArray': '$updateDescription.updatedFields'}, 'in': '$$this.k'}},
+            '$updateDescription.removedFields']}
+        relevant_fields = {'$filter': {'input': changed_fields, 'cond': {
+            '$not': [{'$in': [{'$arrayElemAt': [{'$split': ['$$this', '.']}, 0]}, self.excluded_fields]}]}}}
+        pipeline = [{'$match': {'$or': [
+            {'operationType': {'$in': ['replace', 'delete']}},
+            {'operationType': 'update', '$expr': {'$gt': [{'$size': relevant_fields}, 0]}}]}}]
+        while True:
+            try:
+                async with await self.users.watch(pipeline, full_document='updateLookup') as stream:
+                    logger.info("Watching the users collection for account cache invalidation")
+                    async for change in stream:
+                        self.refresh(change['documentKey']['_id'], change.get('fullDocument'))
+            except OperationFailure as e:
+                # Change streams need a replica set; without one the cache relies on its TTL
+                logger.warning("Account cache invalidation disabled, change stream unavailable: %s", e)
+                return
+            except PyMongoError as e:
+                logger.error("Account cache change stream interrupted: %s", e)
+                # Anything may have changed while the stream was down
+                self.entries.clear()
+                await asyncio.sleep(5)
+
+    def refresh(self, chat_id, document):
+        # Only accounts this process already caches are refreshed, so other processes' users do not fill the cache
+        if chat_id not in self.entries:
+            return
+        if document is None:
+            self.invalidate(chat_id)
+            return
+        for field in self.excluded_fields:
+            document.pop(field, None)
+        self.refreshes += 1
+        self.put(chat_id, document)
+
+    async def close(self):
+        if self.watch_task:
+            self.watch_task.cancel()
+            try:
+                await self.watch_task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            'size': len(self.entries),
+            'hits': self.hits,
+            'misses': self.misses,
+            'evictions': self.evictions,
+            'invalidations': self.invalidations,
+            'refreshes': self.refreshes,
+        }
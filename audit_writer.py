@@ -0,0 +1,185 @@
+import asyncio
+import logging
+import os
+from collections import Counter
+from itertools import islice
+from bson import ObjectId, json_util
+from bson.errors import BSONError
+from pymongo.errors import BulkWriteError, ConnectionFailure
+
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class AuditWriter:
+    """Write-behind buffer for audit records.
+
+    Records are inserted in batches of `batch_size` with `insert_many(ordered=False)`,
+    either when a batch is full or every `flush_interval` seconds. Every record has
+    its `_id` assigned up front, so a batch can be retried without duplicates. When
+    MongoDB is unreachable, or the buffer is full, records are appended to the spill
+    file and replayed on the next successful flush. Spilled lines that cannot be
+    decoded and records MongoDB refuses are moved to `<spill_path>.rejected`, so one
+    bad record cannot hold back the rest. `on_written` is called with every record
+    that is stored or rejected, and called again on the next flush if it fails.
+    """
+
+    def __init__(self, collection, batch_size=500, flush_interval=1.0, max_buffer=10000,
+                 spill_path='audit_spill.jsonl', on_written=None):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.max_buffer = max_buffer
+        self.spill_path = spill_path
+        self.replay_path = spill_path + '.replay'
+        self.rejected_path = spill_path + '.rejected'
+        self.on_written = on_written
+        self.buffer = []
+        # Records stored or rejected that on_written has not accepted yet
+        self.written = []
+        # Records added per chat that on_written has not accepted yet, spilled ones included
+        self.pending_chats = Counter()
+        self.flush_lock = asyncio.Lock()
+        self.batch_ready = asyncio.Event()
+        self.task = None
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def add(self, record):
+        record.setdefault('_id', ObjectId())
+        self.pending_chats[record.get('chat_id')] += 1
+        if len(self.buffer) >= self.max_buffer:
+            self.spill([record])
+            return
+        self.buffer.append(record)
+        if len(self.buffer) >= self.batch_size:
+            self.batch_ready.set()
+
+    async def run(self):
+        while True:
+            try:
+                async with asyncio.timeout(self.flush_interval):
+                    await self.batch_ready.wait()
+            except TimeoutError:
+                pass
+            self.batch_ready.clear()
+            await self.flush()
+
+    async def flush(self):
+        async with self.flush_lock:
+            await self.acknowledge()
+            try:
+                await self.replay_spill()
+                while self.buffer:
+                    batch = self.buffer[:self.batch_size]
+                    await self.write(batch)
+                    del self.buffer[:len(batch)]
+            except ConnectionFailure as e:
+                if self.buffer:
+                    logger.warning("MongoDB unreachable, spilling %s audit records to %s: %s", len(self.buffer), self.spill_path, e)
+                    self.spill(self.buffer)
+                    self.buffer = []
+            except Exception as e:
+                if self.buffer:
+                    logger.error("Error writing %s audit records, spilling them to %s: %s", len(self.buffer), self.spill_path, e)
+                    self.spill(self.buffer)
+                    self.buffer = []
+
+    async def write(self, records):
+        rejected = 0
+        try:
+            await self.collection.insert_many(records, ordered=False)
+        except BulkWriteError as e:
+            if e.details.get('writeConcernErrors'):
+                raise
+            errors = [error for error in e.details['writeErrors'] if error['code'] != DUPLICATE_KEY_ERROR]
+            if errors:
+                # Retrying a record the server refused fails the same way every time
+                logger.error("MongoDB refused %s audit records, moving them to %s: %s",
+                             len(errors), self.rejected_path, errors[0].get('errmsg'))
+                self.reject(json_util.dumps(records[error['index']]) + '\n' for error in errors)
+                rejected = len(errors)
+        logger.debug("Wrote %s audit records", len(records) - rejected)
+        # Rejected records are done with too, or they would be relayed from the outbox forever
+        self.written += records
+        await self.acknowledge()
+
+    async def acknowledge(self):
+        if not self.written:
+            return
+        if self.on_written:
+            try:
+                await self.on_written(self.written)
+            except Exception as e:
+                logger.error("Error in audit write callback, retrying %s records on the next flush: %s", len(self.written), e)
+                return
+        for record in self.written:
+            chat_id = record.get('chat_id')
+            # Records replayed from a previous run's spill file were never added here
+            if self.pending_chats[chat_id] > 1:
+                self.pending_chats[chat_id] -= 1
+            else:
+                del self.pending_chats[chat_id]
+        self.written = []
+
+    def pending(self, chat_id):
+        """Returns the chat's records not acknowledged yet, or None if some of them are only in the spill file."""
+        count = self.pending_chats.get(chat_id, 0)
+        if not count:
+            return []
+        records = [record for record in self.buffer + self.written if record.get('chat_id') == chat_id]
+        return records if len(records) >= count else None
+
+    def spill(self, records):
+        with open(self.spill_path, 'ab+') as spill_file:
+            # A crash mid-append leaves a partial last line; never glue the next record onto it
+            if spill_file.seek(0, os.SEEK_END):
+                spill_file.seek(-1, os.SEEK_END)
+                if spill_file.read(1) != b'\n':
+                    spill_file.write(b'\n')
+            for record in records:
+                spill_file.write((json_util.dumps(record) + '\n').encode())
+
+    def reject(self, lines):
+        with open(self.rejected_path, 'a') as rejected_file:
+            rejected_file.writelines(lines)
+
+    async def replay_spill(self):
+        # The spill file is moved aside first so records spilled during the replay are not lost
+        if not os.path.exists(self.replay_path):
+            if not os.path.exists(self.spill_path):
+                return
+            os.replace(self.spill_path, self.replay_path)
+
+        replayed = 0
+        with open(self.replay_path) as replay_file:
+            while True:
+                lines = list(islice(replay_file, self.batch_size))
+                if not lines:
+                    break
+                records = []
+                for line in lines:
+                    if not line.strip():
+                        continue
+                    try:
+                        records.append(json_util.loads(line))
+                    except (ValueError, TypeError, BSONError) as e:
+                        logger.warning("Unreadable spilled audit record moved to %s: %s", self.rejected_path, e)
+                        self.reject([line.rstrip('\n') + '\n'])
+                if records:
+                    await self.write(records)
+                replayed += len(records)
+        os.remove(self.replay_path)
+        logger.info("Replayed %s spilled audit records", replayed)
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        await self.flush()
@@ -0,0 +1,93 @@
+import asyncio
+import time
+from urllib.parse import parse_qsl
+from aiohttp import web
+
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Bench', 'username': 'bench_bot'}
+
+
+class FakeTelegramApi:
+    """Local stand-in for the Bot API: serves queued updates and records sent messages.
+
+    `latency` seconds are added to every sendMessage call to model the round trip to
+    Telegram. `on_message(chat_id, text)` is called for every message the bot sends.
+    """
+
+    def __init__(self, latency=0.0, on_message=None):
+        self.latency = latency
+        self.on_message = on_message
+        self.updates = []
+        self.next_update_id = 1
+        self.next_message_id = 1
+        self.update_available = asyncio.Event()
+        self.served_at = {}
+        self.sent = []
+        self.runner = None
+
+    def push_update(self, update):
+        update_id = self.next_update_id
+        self.next_update_id += 1
+        self.updates.append({'update_id': update_id, **update})
+        self.update_available.set()
+        return update_id
+
+    async def start(self, host='127.0.0.1', port=0):
+        app = web.Application()
+        app.router.add_route('*', '/bot{token}/{method}', self.handle)
+        self.runner = web.AppRunner(app)
+        await self.runner.setup()
+        site = web.TCPSite(self.runner, host, port)
+        await site.start()
+        port = site._server.sockets[0].getsockname()[1]
+        return f'http://{host}:{port}/bot{{0}}/{{1}}'
+
+    async def stop(self):
+        if self.runner:
+            await self.runner.cleanup()
+
+    async def handle(self, request):
+        params = await read_params(request)
+        method = request.match_info['method']
+        if method == 'getUpdates':
+            result = await self.get_updates(int(params.get('offset') or 0), float(params.get('timeout') or 0))
+        elif method == 'sendMessage':
+            result = await self.send_message(int(params['chat_id']), params.get('text', ''))
+        elif method == 'getMe':
+            result = BOT_USER
+        else:
+            result = True
+        return web.json_response({'ok': True, 'result': result})
+
+    async def get_updates(self, offset, timeout):
+        self.updates = [update for update in self.updates if update['update_id'] >= offset]
+        if not self.updates:
+            self.update_available.clear()
+            try:
+                async with asyncio.timeout(timeout):
+                    await self.update_available.wait()
+            except TimeoutError:
+                return []
+        batch = self.updates[:100]
+        now = time.perf_counter()
+        for update in batch:
+            self.served_at.setdefault(update['update_id'], now)
+        return batch
+
+    async def send_message(self, chat_id, text):
+        await asyncio.sleep(self.latency)
+        self.sent.append((time.perf_counter(), chat_id))
+        message_id = self.next_message_id
+        self.next_message_id += 1
+        if self.on_message:
+            self.on_message(chat_id, text)
+        return {'message_id': message_id, 'date': int(time.time()), 'from': BOT_USER,
+                'chat': {'id': chat_id, 'type': 'private'}, 'text': text}
+
+
+async def read_params(request):
+    # telebot sends form-encoded bodies, even on GET requests
+    body = await request.read()
+    if request.content_type.startswith('multipart/'):
+        return {key: value for key, value in (await request.post()).items()}
+    return dict(parse_qsl(body.decode()))
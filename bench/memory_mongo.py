@@ -0,0 +1,413 @@
+import asyncio
+import copy
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument
+from pymongo.errors import BulkWriteError, DuplicateKeyError, OperationFailure
+
+
+DUPLICATE_KEY_ERROR = 11000
+
+
+class MemoryMongoClient:
+    """In-memory stand-in for AsyncMongoClient covering the operations the bot uses.
+
+    Every operation waits `latency` seconds first, to model the network round trip
+    to a real server. Documents are copied in and out and datetimes are truncated to
+    milliseconds, like BSON does.
+    """
+
+    def __init__(self, uri=None, latency=0.0, **kwargs):
+        self.latency = latency
+        self.databases = {}
+        self.admin = MemoryDatabase(self, 'admin')
+
+    def __getitem__(self, name):
+        if name not in self.databases:
+            self.databases[name] = MemoryDatabase(self, name)
+        return self.databases[name]
+
+    async def close(self):
+        pass
+
+
+class MemoryDatabase:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.collections = {}
+
+    def __getitem__(self, name):
+        if name not in self.collections:
+            self.collections[name] = MemoryCollection(self.client, name)
+        return self.collections[name]
+
+    async def command(self, name, *args, **kwargs):
+        await asyncio.sleep(self.client.latency)
+        return {'ok': 1.0}
+
+    async def list_collection_names(self):
+        await asyncio.sleep(self.client.latency)
+        return list(self.collections)
+
+    async def create_collection(self, name):
+        await asyncio.sleep(self.client.latency)
+        return self[name]
+
+
+class MemoryCollection:
+    def __init__(self, client, name):
+        self.client = client
+        self.name = name
+        self.documents = {}
+
+    async def round_trip(self):
+        await asyncio.sleep(self.client.latency)
+
+    def scan(self, query):
+        if '_id' in query and not isinstance(query['_id'], dict):
+            document = self.documents.get(query['_id'])
+            return [document] if document is not None and matches(document, query) else []
+        return [document for document in self.documents.values() if matches(document, query)]
+
+    async def create_index(self, keys, **kwargs):
+        await self.round_trip()
+        if isinstance(keys, str):
+            return f'{keys}_1'
+        return '_'.join(f'{field}_{direction}' for field, direction in keys)
+
+    async def find_one(self, query=None, projection=None):
+        await self.round_trip()
+        found = self.scan(query or {})
+        return project(found[0], projection) if found else None
+
+    def find(self, query=None, projection=None):
+        return MemoryCursor(self, query or {}, projection)
+
+    async def count_documents(self, query):
+        await self.round_trip()
+        return len(self.scan(query))
+
+    async def insert_one(self, document):
+        await self.round_trip()
+        self.insert(document)
+
+    async def insert_many(self, documents, ordered=True):
+        await self.round_trip()
+        errors = []
+        for index, document in enumerate(documents):
+            try:
+                self.insert(document)
+            except DuplicateKeyError:
+                errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'duplicate key'})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': [], 'nInserted': len(documents) - len(errors)})
+
+    def insert(self, document):
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        if document['_id'] in self.documents:
+            raise DuplicateKeyError('duplicate key', DUPLICATE_KEY_ERROR)
+        self.documents[document['_id']] = to_bson(document)
+
+    async def update_one(self, query, update, upsert=False):
+        await self.round_trip()
+        self.update(query, update, upsert)
+
+    async def replace_one(self, query, replacement, upsert=False):
+        await self.round_trip()
+        found = self.scan(query)
+        if found:
+            replacement = {**replacement, '_id': found[0]['_id']}
+            self.documents[found[0]['_id']] = to_bson(replacement)
+        elif upsert:
+            self.insert({**replacement, '_id': query.get('_id', ObjectId())})
+
+    async def find_one_and_update(self, query, update, projection=None, return_document=ReturnDocument.BEFORE, upsert=False):
+        await self.round_trip()
+        before, after = self.update(query, update, upsert)
+        document = after if return_document == ReturnDocument.AFTER else before
+        return project(document, projection) if document is not None else None
+
+    async def find_one_and_delete(self, query, projection=None):
+        await self.round_trip()
+        found = self.scan(query)
+        if not found:
+            return None
+        return project(self.documents.pop(found[0]['_id']), projection)
+
+    async def delete_one(self, query):
+        await self.round_trip()
+        found = self.scan(query)
+        if found:
+            del self.documents[found[0]['_id']]
+
+    async def bulk_write(self, requests, ordered=True):
+        await self.round_trip()
+        errors = []
+        for index, request in enumerate(requests):
+            try:
+                self.update(request._filter, request._doc, bool(request._upsert))
+            except DuplicateKeyError:
+                errors.append({'index': index, 'code': DUPLICATE_KEY_ERROR, 'errmsg': 'duplicate key'})
+                if ordered:
+                    break
+        if errors:
+            raise BulkWriteError({'writeErrors': errors, 'writeConcernErrors': []})
+
+    async def drop(self):
+        await self.round_trip()
+        self.documents.clear()
+
+    async def watch(self, *args, **kwargs):
+        raise OperationFailure('The $changeStream stage is only supported on replica sets', 40573)
+
+    def update(self, query, update, upsert):
+        found = self.scan(query)
+        if found:
+            before = found[0]
+        elif upsert:
+            before = None
+            found = [{key: value for key, value in query.items() if not key.startswith('$') and not isinstance(value, dict)}]
+            if found[0].get('_id') in self.documents:
+                # The filter missed an existing document, so the upsert's insert collides with it
+                raise DuplicateKeyError('duplicate key', DUPLICATE_KEY_ERROR)
+        else:
+            return None, None
+
+        document = copy.deepcopy(found[0])
+        if isinstance(update, list):
+            # Every expression of a stage sees the document as it was before that stage
+            for stage in update:
+                source = copy.deepcopy(document)
+                for field, expression in stage['$set'].items():
+                    set_path(document, field, evaluate(expression, source))
+        else:
+            apply_operators(document, update, inserting=before is None)
+        if '_id' not in document:
+            document['_id'] = ObjectId()
+        self.documents[document['_id']] = to_bson(document)
+        return (copy.deepcopy(before) if before is not None else None), copy.deepcopy(self.documents[document['_id']])
+
+
+class MemoryCursor:
+    def __init__(self, collection, query, projection):
+        self.collection = collection
+        self.query = query
+        self.projection = projection
+        self.sort_keys = []
+        self.skip_count = 0
+        self.limit_count = 0
+        self.results = None
+
+    def sort(self, key_or_list, direction=None):
+        self.sort_keys = [(key_or_list, direction or 1)] if isinstance(key_or_list, str) else list(key_or_list)
+        return self
+
+    def skip(self, count):
+        self.skip_count = count
+        return self
+
+    def limit(self, count):
+        self.limit_count = count
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def load(self):
+        if self.results is None:
+            await self.collection.round_trip()
+            documents = self.collection.scan(self.query)
+            for field, direction in reversed(self.sort_keys):
+                documents.sort(key=lambda document: sort_key(get_path(document, field)), reverse=direction < 0)
+            documents = documents[self.skip_count:]
+            if self.limit_count:
+                documents = documents[:self.limit_count]
+            self.results = [project(document, self.projection) for document in documents]
+        return self.results
+
+    async def to_list(self, length=None):
+        results = await self.load()
+        return results[:length] if length else list(results)
+
+    def __aiter__(self):
+        return self.iterate()
+
+    async def iterate(self):
+        for document in await self.load():
+            yield document
+
+    async def close(self):
+        pass
+
+
+MISSING = object()
+
+
+def to_bson(value):
+    if isinstance(value, datetime):
+        return value.replace(microsecond=value.microsecond // 1000 * 1000)
+    if isinstance(value, dict):
+        return {key: to_bson(item) for key, item in value.items()}
+    if isinstance(value, (list, tuple)):
+        return [to_bson(item) for item in value]
+    return value
+
+
+def get_path(document, path):
+    value = document
+    for part in path.split('.'):
+        if isinstance(value, dict):
+            value = value.get(part, MISSING)
+        elif isinstance(value, list) and part.isdigit():
+            value = value[int(part)] if int(part) < len(value) else MISSING
+        else:
+            return MISSING
+        if value is MISSING:
+            return MISSING
+    return value
+
+
+def path_values(value, parts):
+    # Like a MongoDB query path: a list without an index fans out over its elements
+    if not parts:
+        return [value]
+    if isinstance(value, dict):
+        return path_values(value[parts[0]], parts[1:]) if parts[0] in value else [MISSING]
+    if isinstance(value, list):
+        if parts[0].isdigit():
+            return path_values(value[int(parts[0])], parts[1:]) if int(parts[0]) < len(value) else [MISSING]
+        return [item for element in value for item in path_values(element, parts)] or [MISSING]
+    return [MISSING]
+
+
+def set_path(document, path, value):
+    parts = path.split('.')
+    for part in parts[:-1]:
+        document = document.setdefault(part, {})
+    document[parts[-1]] = value
+
+
+def sort_key(value):
+    return (value is MISSING or value is None, value if value is not MISSING else None)
+
+
+def compare(value, operator, operand):
+    if operator == '$exists':
+        return (value is not MISSING) == bool(operand)
+    if operator == '$in':
+        return value in operand
+    if operator == '$nin':
+        return value not in operand
+    if operator == '$ne':
+        return value != operand
+    if operator == '$eq':
+        return value == operand
+    if value is MISSING or value is None:
+        return False
+    try:
+        if operator == '$lt':
+            return value < operand
+        if operator == '$lte':
+            return value <= operand
+        if operator == '$gt':
+            return value > operand
+        if operator == '$gte':
+            return value >= operand
+    except TypeError:
+        return False
+    raise NotImplementedError(f"Query operator {operator} is not supported")
+
+
+def matches(document, query):
+    for field, condition in query.items():
+        if field == '$or':
+            if not any(matches(document, clause) for clause in condition):
+                return False
+        elif field == '$and':
+            if not all(matches(document, clause) for clause in condition):
+                return False
+        elif isinstance(condition, dict) and condition and all(key.startswith('$') for key in condition):
+            values = path_values(document, field.split('.'))
+            if not any(all(compare(value, operator, operand) for operator, operand in condition.items())
+                       for value in values):
+                return False
+        elif get_path(document, field) != condition:
+            return False
+    return True
+
+
+def project(document, projection):
+    document = copy.deepcopy(document)
+    if not projection:
+        return document
+    slices = {field: spec['$slice'] for field, spec in projection.items() if isinstance(spec, dict)}
+    included = [field for field, spec in projection.items() if not isinstance(spec, dict) and spec and field != '_id']
+    excluded = [field for field, spec in projection.items() if not isinstance(spec, dict) and not spec]
+    if included:
+        result = {'_id': document['_id']} if projection.get('_id', 1) else {}
+        for field in included + list(slices):
+            if field in document:
+                result[field] = document[field]
+        document = result
+    for field in excluded:
+        document.pop(field, None)
+    for field, count in slices.items():
+        if isinstance(document.get(field), list):
+            document[field] = document[field][count:] if count < 0 else document[field][:count]
+    return document
+
+
+def apply_operators(document, update, inserting=False):
+    for operator, fields in update.items():
+        for field, value in fields.items():
+            if operator == '$set':
+                set_path(document, field, copy.deepcopy(value))
+            elif operator == '$setOnInsert':
+                if inserting:
+                    set_path(document, field, copy.deepcopy(value))
+            elif operator == '$inc':
+                current = get_path(document, field)
+                set_path(document, field, (0 if current is MISSING else current) + value)
+            elif operator == '$unset':
+                document.pop(field, None)
+            elif operator == '$push':
+                current = get_path(document, field)
+                set_path(document, field, ([] if current is MISSING else current) + [copy.deepcopy(value)])
+            elif operator == '$pull':
+                current = get_path(document, field)
+                if isinstance(current, list):
+                    condition = value if isinstance(value, dict) else None
+                    set_path(document, field, [item for item in current
+                                               if not (matches(item, condition) if condition else item == value)])
+            else:
+                raise NotImplementedError(f"Update operator {operator} is not supported")
+
+
+def evaluate(expression, document):
+    if isinstance(expression, str) and expression.startswith('$'):
+        value = get_path(document, expression[1:])
+        return None if value is MISSING else copy.deepcopy(value)
+    if isinstance(expression, list):
+        return [evaluate(item, document) for item in expression]
+    if isinstance(expression, dict):
+        if len(expression) == 1:
+            operator, operands = next(iter(expression.items()))
+            if operator == '$literal':
+                return copy.deepcopy(operands)
+            if operator.startswith('$'):
+                values = evaluate(operands, document)
+                if operator == '$add':
+                    return sum(values)
+                if operator == '$subtract':
+                    return values[0] - values[1]
+                if operator == '$ifNull':
+                    return next((value for value in values if value is not None), None)
+                if operator == '$concatArrays':
+                    return [item for value in values for item in value]
+                raise NotImplementedError(f"Expression operator {operator} is not supported")
+        return {key: evaluate(value, document) for key, value in expression.items()}
+    return copy.deepcopy(expression)
@@ -0,0 +1,254 @@
+"""Replays a synthetic workload against bot.py with a fake Bot API and reports latencies.
+
+Run from the repository root:
+
+    python -m bench.run --users 200 --actions 10
+    python -m bench.run --baseline bench/baseline.json
+    python -m bench.run --save-baseline bench/baseline.json
+
+Without --mongo-uri the bot talks to an in-memory MongoDB double; with it, the
+given server is used and the bench database is dropped first.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+import time
+from collections import defaultdict
+
+
+BENCH_DB_NAME = 'bot_bank_bench'
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark bot.py against a local fake Telegram API.")
+    parser.add_argument('--users', type=int, default=200, help="number of simulated users")
+    parser.add_argument('--actions', type=int, default=10, help="actions per user after /start")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--telegram-latency', type=float, default=0.02, help="seconds added to every sendMessage")
+    parser.add_argument('--mongo-latency', type=float, default=0.001, help="seconds added to every in-memory Mongo operation")
+    parser.add_argument('--mongo-uri', help="use this MongoDB server instead of the in-memory double")
+    parser.add_argument('--telegram-limits', action='store_true', help="keep the bot's real Telegram rate limits")
+    parser.add_argument('--reply-timeout', type=float, default=10, help="seconds to wait for a reply before moving on")
+    parser.add_argument('--output', help="write the JSON report to this file")
+    parser.add_argument('--baseline', help="compare against this JSON report")
+    parser.add_argument('--save-baseline', help="write the JSON report as the new baseline")
+    parser.add_argument('--tolerance', type=float, default=0.5, help="allowed relative regression against the baseline")
+    parser.add_argument('--verbose', action='store_true', help="keep the bot's INFO logging")
+    return parser.parse_args(argv)
+
+
+def configure_environment(args):
+    # Must happen before bot.py is imported, since it reads its settings at import time
+    os.environ['TELEGRAM_BOT_TOKEN'] = '123456:bench-token'
+    os.environ['DB_NAME'] = BENCH_DB_NAME
+    os.environ['MONGO_URI'] = args.mongo_uri or 'mongodb://memory'
+    os.environ['RUN_MODE'] = 'polling'
+    os.environ['WORKER_PROCESSES'] = '1'
+    os.environ['POLLING_TIMEOUT'] = '1'
+    os.environ['AUDIT_SPILL_PATH'] = os.path.join('bench', 'audit_spill.jsonl')
+    if not args.telegram_limits:
+        os.environ['TELEGRAM_GLOBAL_RATE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_RATE'] = '1000000'
+        os.environ['TELEGRAM_CHAT_BURST'] = '1000000'
+
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return 0.0
+    index = max(0, min(len(sorted_values) - 1, round(fraction * len(sorted_values) + 0.5) - 1))
+    return sorted_values[index]
+
+
+def summarize(samples):
+    values = sorted(samples)
+    return {
+        'count': len(values),
+        'p50_ms': round(percentile(values, 0.50) * 1000, 3),
+        'p95_ms': round(percentile(values, 0.95) * 1000, 3),
+        'p99_ms': round(percentile(values, 0.99) * 1000, 3),
+    }
+
+
+class Replay:
+    """Feeds each user's next step as soon as the bot has replied to the previous one."""
+
+    def __init__(self, api, workload, reply_timeout):
+        self.api = api
+        self.scripts = workload
+        self.reply_timeout = reply_timeout
+        self.positions = {chat_id: 0 for chat_id in workload}
+        self.outstanding = {}
+        self.labels = {}
+        self.end_to_end = defaultdict(list)
+        self.remaining = len(workload)
+        self.timeouts = 0
+        self.done = asyncio.Event()
+
+    def start(self):
+        for chat_id in self.scripts:
+            self.send_next(chat_id)
+
+    def send_next(self, chat_id):
+        position = self.positions[chat_id]
+        if position == len(self.scripts[chat_id]):
+            self.remaining -= 1
+            if self.remaining == 0:
+                self.done.set()
+            return
+        label, update = self.scripts[chat_id][position]
+        self.positions[chat_id] = position + 1
+        update_id = self.api.push_update(update)
+        self.labels[update_id] = label
+        timer = asyncio.get_running_loop().call_later(self.reply_timeout, self.on_timeout, chat_id, update_id)
+        self.outstanding[chat_id] = (update_id, timer)
+
+    def on_reply(self, chat_id, text):
+        if chat_id not in self.outstanding:
+            return
+        update_id, timer = self.outstanding.pop(chat_id)
+        timer.cancel()
+        served_at = self.api.served_at.get(update_id)
+        if served_at is not None:
+            self.end_to_end[self.labels[update_id]].append(time.perf_counter() - served_at)
+        self.send_next(chat_id)
+
+    def on_timeout(self, chat_id, update_id):
+        if self.outstanding.get(chat_id, (None,))[0] == update_id:
+            del self.outstanding[chat_id]
+            self.timeouts += 1
+            self.send_next(chat_id)
+
+
+async def run_benchmark(args):
+    import bot
+    from telebot import asyncio_helper
+    from dispatcher import ChatDispatcher
+    from bench.fake_telegram import FakeTelegramApi
+    from bench.memory_mongo import MemoryMongoClient
+    from bench.workload import generate_workload
+
+    if not args.verbose:
+        logging.getLogger().setLevel(logging.WARNING)
+
+    if args.mongo_uri:
+        from pymongo import AsyncMongoClient
+        cleanup_client = AsyncMongoClient(args.mongo_uri)
+        await cleanup_client.drop_database(BENCH_DB_NAME)
+        await cleanup_client.close()
+    else:
+        bot.mongo.client_factory = lambda uri, **kwargs: MemoryMongoClient(uri, latency=args.mongo_latency, **kwargs)
+
+    workload = generate_workload(args.users, args.actions, args.seed)
+    api = FakeTelegramApi(latency=args.telegram_latency)
+    replay = Replay(api, workload, args.reply_timeout)
+    api.on_message = replay.on_reply
+    asyncio_helper.API_URL = await api.start()
+
+    handler_times = defaultdict(list)
+
+    async def timed_process_update(update):
+        started = time.perf_counter()
+        await bot.process_update(update)
+        handler_times[replay.labels.get(update.update_id, 'other')].append(time.perf_counter() - started)
+
+    await bot.start_services()
+    # Startup no longer waits for MongoDB; measure from the point the bot can serve requests
+    while not bot.mongo.available:
+        await asyncio.sleep(0.01)
+    dispatcher = ChatDispatcher(timed_process_update, max_workers=bot.MAX_CONCURRENT_UPDATES, max_pending=bot.UPDATE_QUEUE_SIZE)
+    polling = asyncio.create_task(bot.poll_updates(dispatcher))
+
+    started = time.perf_counter()
+    replay.start()
+    await replay.done.wait()
+    elapsed = time.perf_counter() - started
+
+    polling.cancel()
+    try:
+        await polling
+    except asyncio.CancelledError:
+        pass
+    await dispatcher.drain(bot.DRAIN_TIMEOUT)
+    await bot.stop_services()
+    await api.stop()
+
+    updates = sum(len(samples) for samples in handler_times.values())
+    return {
+        'config': {
+            'users': args.users,
+            'actions': args.actions,
+            'seed': args.seed,
+            'telegram_latency': args.telegram_latency,
+            'mongo': 'server' if args.mongo_uri else f'memory ({args.mongo_latency}s latency)',
+            'telegram_limits': args.telegram_limits,
+        },
+        'elapsed_s': round(elapsed, 3),
+        'updates': updates,
+        'messages_sent': len(api.sent),
+        'reply_timeouts': replay.timeouts,
+        'throughput_updates_per_s': round(updates / elapsed, 1) if elapsed else 0.0,
+        'handlers': {label: summarize(samples) for label, samples in sorted(handler_times.items())},
+        'end_to_end': {label: summarize(samples) for label, samples in sorted(replay.end_to_end.items())},
+    }
+
+
+def print_report(report):
+    print(f"{report['updates']} updates in {report['elapsed_s']}s: "
+          f"{report['throughput_updates_per_s']} updates/s, {report['messages_sent']} messages sent, "
+          f"{report['reply_timeouts']} reply timeouts")
+    print(f"{'handler':<28}{'count':>7}{'p50 ms':>10}{'p95 ms':>10}{'p99 ms':>10}{'e2e p50':>10}{'e2e p95':>10}{'e2e p99':>10}")
+    for label, stats in report['handlers'].items():
+        e2e = report['end_to_end'].get(label, {})
+        print(f"{label:<28}{stats['count']:>7}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}{stats['p99_ms']:>10.2f}"
+              f"{e2e.get('p50_ms', 0):>10.2f}{e2e.get('p95_ms', 0):>10.2f}{e2e.get('p99_ms', 0):>10.2f}")
+
+
+def compare_with_baseline(report, baseline, tolerance):
+    regressions = []
+    if report['throughput_updates_per_s'] < baseline['throughput_updates_per_s'] * (1 - tolerance):
+        regressions.append(f"throughput {report['throughput_updates_per_s']} < baseline {baseline['throughput_updates_per_s']}")
+    for section in ('handlers', 'end_to_end'):
+        for label, stats in report[section].items():
+            reference = baseline.get(section, {}).get(label)
+            if not reference:
+                continue
+            # p99 over a few hundred samples is too noisy to gate on
+            for key in ('p50_ms', 'p95_ms'):
+                if stats[key] > reference[key] * (1 + tolerance):
+                    regressions.append(f"{section} {label} {key} {stats[key]} > baseline {reference[key]}")
+    return regressions
+
+
+def main(argv=None):
+    args = parse_args(argv)
+    configure_environment(args)
+    report = asyncio.run(run_benchmark(args))
+    print_report(report)
+
+    if args.output:
+        with open(args.output, 'w') as output_file:
+            json.dump(report, output_file, indent=2)
+    if args.save_baseline:
+        with open(args.save_baseline, 'w') as baseline_file:
+            json.dump(report, baseline_file, indent=2)
+        print(f"Baseline saved to {args.save_baseline}")
+    if args.baseline:
+        with open(args.baseline) as baseline_file:
+            baseline = json.load(baseline_file)
+        if baseline.get('config') != report['config']:
+            print("Warning: the baseline was recorded with a different configuration")
+        regressions = compare_with_baseline(report, baseline, args.tolerance)
+        if regressions:
+            print(f"{len(regressions)} regressions against {args.baseline}:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print(f"No regressions against {args.baseline} (tolerance {args.tolerance:.0%})")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
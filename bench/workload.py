@@ -0,0 +1,67 @@
+import itertools
+import random
+import time
+
+
+DEFAULT_MIX = {'balance': 3, 'deposit': 3, 'withdraw': 2, 'history': 2}
+
+ids = itertools.count(1)
+
+
+def user_of(chat_id):
+    return {'id': chat_id, 'is_bot': False, 'first_name': f'User {chat_id}'}
+
+
+def text_update(chat_id, text):
+    return {'message': {'message_id': next(ids), 'date': int(time.time()), 'from': user_of(chat_id),
+                        'chat': {'id': chat_id, 'type': 'private'}, 'text': text}}
+
+
+def callback_update(chat_id, data):
+    return {'callback_query': {
+        'id': str(next(ids)),
+        'from': user_of(chat_id),
+        'chat_instance': str(chat_id),
+        'data': data,
+        'message': {'message_id': next(ids), 'date': int(time.time()),
+                    'chat': {'id': chat_id, 'type': 'private'}, 'text': 'menu'}}}
+
+
+def user_script(rng, chat_id, actions, mix):
+    """Returns the (handler, update) steps one user goes through, in order.
+
+    Every step gets exactly one reply from the bot, so the next step can be sent as
+    soon as the reply to the previous one arrives.
+    """
+    steps = [('handle_start', text_update(chat_id, '/start'))]
+    balance = 0
+    names = list(mix)
+    weights = [mix[name] for name in names]
+    for _ in range(actions):
+        action = rng.choices(names, weights)[0]
+        if action == 'withdraw' and balance < 1:
+            action = 'deposit'
+
+        if action == 'balance':
+            steps.append(('check_balance', callback_update(chat_id, 'check_balance')))
+        elif action == 'history':
+            steps.append(('show_history', callback_update(chat_id, 'history')))
+        elif action == 'deposit':
+            amount = float(rng.randint(1, 500))
+            balance += amount
+            steps += [('start_deposit', callback_update(chat_id, 'deposit')),
+                      ('process_deposit_amount', text_update(chat_id, str(amount))),
+                      ('confirm_deposit', callback_update(chat_id, f'confirm_deposit_{amount}'))]
+        elif action == 'withdraw':
+            amount = float(rng.randint(1, int(balance)))
+            balance -= amount
+            steps += [('start_withdrawal', callback_update(chat_id, 'withdraw')),
+                      ('process_withdrawal_amount', text_update(chat_id, str(amount))),
+                      ('confirm_withdrawal', callback_update(chat_id, f'confirm_withdraw_{amount}'))]
+    return steps
+
+
+def generate_workload(users, actions, seed=1, mix=None, first_chat_id=100000):
+    rng = random.Random(seed)
+    return {chat_id: user_script(rng, chat_id, actions, mix or DEFAULT_MIX)
+            for chat_id in range(first_chat_id, first_chat_id + users)}
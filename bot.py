@@ -2,14 +2,27 @@ import sys
 print(f"Python version: {sys.version}")
 print(f"Python path: {sys.executable}")
 
-from telebot import TeleBot
-from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton
-from pymongo import MongoClient
-from pymongo.errors import ConnectionFailure
-from datetime import datetime
+from telebot.async_telebot import AsyncTeleBot
+from telebot.types import InlineKeyboardMarkup, InlineKeyboardButton, ReplyParameters
+from telebot import asyncio_helper
+from bson import ObjectId
+import asyncio
 import logging
 import os
+import signal
+from datetime import datetime, timedelta
 from dotenv import load_dotenv
+from dispatcher import ChatDispatcher
+from ledger import Ledger, OUTBOX_FIELD
+from account_cache import AccountCache
+from message_sender import MessageSender, PRIORITY_TRANSACTION
+from conversation import (MemoryStateStore, MongoStateStore, AWAITING_DEPOSIT_AMOUNT,
+                          AWAITING_WITHDRAWAL_AMOUNT, PENDING_CONFIRMATION)
+from workers import PartitionedDispatcher, receive_updates
+from audit_writer import AuditWriter
+from webhook import run_webhook
+from mongo_connection import MongoConnectionManager
+import metrics
 
 
 load_dotenv()
@@ -20,64 +33,110 @@ logger = logging.getLogger(__name__)
 
 
 TOKEN = os.getenv('TELEGRAM_BOT_TOKEN')
-bot = TeleBot(TOKEN)
-
 
 MONGO_URI = os.getenv('MONGO_URI')
 DB_NAME = os.getenv('DB_NAME')
-
-
-db_available = False
+MONGO_MAX_POOL_SIZE = int(os.getenv('MONGO_MAX_POOL_SIZE', '100'))
+MONGO_MIN_POOL_SIZE = int(os.getenv('MONGO_MIN_POOL_SIZE', '0'))
+MONGO_CONNECT_TIMEOUT_MS = int(os.getenv('MONGO_CONNECT_TIMEOUT_MS', '5000'))
+MONGO_SERVER_SELECTION_TIMEOUT_MS = int(os.getenv('MONGO_SERVER_SELECTION_TIMEOUT_MS', '5000'))
+MONGO_SOCKET_TIMEOUT_MS = int(os.getenv('MONGO_SOCKET_TIMEOUT_MS', '10000'))
+MONGO_HEALTH_INTERVAL = float(os.getenv('MONGO_HEALTH_INTERVAL', '5'))
+MONGO_FAILURE_THRESHOLD = int(os.getenv('MONGO_FAILURE_THRESHOLD', '2'))
+
+RUN_MODE = os.getenv('RUN_MODE', 'polling')
+MAX_CONCURRENT_UPDATES = int(os.getenv('MAX_CONCURRENT_UPDATES', '200'))
+UPDATE_QUEUE_SIZE = int(os.getenv('UPDATE_QUEUE_SIZE', '2000'))
+DRAIN_TIMEOUT = float(os.getenv('DRAIN_TIMEOUT', '30'))
+POLLING_TIMEOUT = int(os.getenv('POLLING_TIMEOUT', '20'))
+
+WORKER_PROCESSES = int(os.getenv('WORKER_PROCESSES', '1'))
+CONVERSATION_STORE = os.getenv('CONVERSATION_STORE', 'mongo')
+CONVERSATION_TTL = int(os.getenv('CONVERSATION_TTL', '900'))
+
+HISTORY_PAGE_SIZE = 10
+
+AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', '500'))
+AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', '1.0'))
+AUDIT_BUFFER_SIZE = int(os.getenv('AUDIT_BUFFER_SIZE', '10000'))
+AUDIT_SPILL_PATH = os.getenv('AUDIT_SPILL_PATH', 'audit_spill.jsonl')
+
+ACCOUNT_CACHE_SIZE = int(os.getenv('ACCOUNT_CACHE_SIZE', '10000'))
+ACCOUNT_CACHE_TTL = float(os.getenv('ACCOUNT_CACHE_TTL', '60'))
+ACCOUNT_CACHE_WATCH = os.getenv('ACCOUNT_CACHE_WATCH', 'false').lower() == 'true'
+
+TELEGRAM_GLOBAL_RATE = float(os.getenv('TELEGRAM_GLOBAL_RATE', '30'))
+TELEGRAM_CHAT_RATE = float(os.getenv('TELEGRAM_CHAT_RATE', '1'))
+TELEGRAM_CHAT_BURST = int(os.getenv('TELEGRAM_CHAT_BURST', '3'))
+TELEGRAM_POOL_SIZE = int(os.getenv('TELEGRAM_POOL_SIZE', '50'))
+
+WEBHOOK_HOST = os.getenv('WEBHOOK_HOST', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('WEBHOOK_PORT', '8080'))
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', '/webhook')
+WEBHOOK_URL = os.getenv('WEBHOOK_URL')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET')
+
+METRICS_HOST = os.getenv('METRICS_HOST', '0.0.0.0')
+METRICS_PORT = int(os.getenv('METRICS_PORT', '0'))
+
+
+# Keep-alive connection pool shared by every Bot API request
+asyncio_helper.REQUEST_LIMIT = TELEGRAM_POOL_SIZE
+# Covers every Bot API call, not just the ones the sender makes
+metrics.instrument_telegram_requests()
+bot = AsyncTeleBot(TOKEN)
+# The global Bot API limit is shared by all worker processes
+sender = MessageSender(bot, global_rate=TELEGRAM_GLOBAL_RATE / WORKER_PROCESSES, chat_rate=TELEGRAM_CHAT_RATE,
+                       chat_burst=TELEGRAM_CHAT_BURST, max_concurrency=TELEGRAM_POOL_SIZE)
+
+client = None
+db = None
 users = None
 audit = None
+audit_writer = None
+account_cache = None
+ledger = None
+conversations = None
+metrics_runner = None
+
+async def setup_database(db):
+    # Runs once, on the first successful health probe, instead of on every connection attempt
+    existing = await db.list_collection_names()
+    for name in ('users', 'audit'):
+        if name not in existing:
+            await db.create_collection(name)
+            logger.info("Collection '%s' created successfully.", name)
+    await audit.create_index([('chat_id', 1), ('timestamp', -1), ('_id', -1)])
+    await conversations.setup()
+    await ledger.relay_pending()
+
+mongo = MongoConnectionManager(MONGO_URI, DB_NAME, setup=setup_database, probe_interval=MONGO_HEALTH_INTERVAL,
+                               failure_threshold=MONGO_FAILURE_THRESHOLD,
+                               event_listeners=[metrics.MongoCommandListener()],
+                               maxPoolSize=MONGO_MAX_POOL_SIZE, minPoolSize=MONGO_MIN_POOL_SIZE,
+                               connectTimeoutMS=MONGO_CONNECT_TIMEOUT_MS,
+                               serverSelectionTimeoutMS=MONGO_SERVER_SELECTION_TIMEOUT_MS,
+                               socketTimeoutMS=MONGO_SOCKET_TIMEOUT_MS)
 
 def connect_mongodb():
-    global db_available, users, audit
-    try:
-        client = MongoClient(MONGO_URI)
-        client.admin.command('ismaster')
-        logger.info("Successful connection to local MongoDB")
-        db = client[DB_NAME]
-        
-        if 'users' not in db.list_collection_names():
-            db.create_collection('users')
-            logger.info("Collection 'users' created successfully.")
-        users = db['users']
-        
-        if 'audit' not in db.list_collection_names():
-            db.create_collection('audit')
-            logger.info("Collection 'audit' created successfully.")
-        audit = db['audit']
-        
-        db_available = True
-        return client, db
-    except ConnectionFailure:
-        logger.error("Failed to connect to local MongoDB. Check if the MongoDB service is running.")
-        db_available = False
-        return None, None
-
-
-client, db = connect_mongodb()
-
-def register_audit(chat_id, operation_type, amount, previous_balance, current_balance):
-    if not db_available:
-        logger.error("Failed to register audit: database unavailable")
-        return
-    
-    record = {
-        'chat_id': chat_id,
-        'operation_type': operation_type,
-        'amount': amount,
-        'previous_balance': previous_balance,
-        'current_balance': current_balance,
-        'timestamp': datetime.now()
-    }
-    
-    try:
-        audit.insert_one(record)
-        logger.info(f"Audit record created: {record}")
-    except Exception as e:
-        logger.error(f"Error creating audit record: {e}")
+    global client, db, users, audit, audit_writer, account_cache, ledger, conversations
+    # No I/O here: the client connects in the background and the health probe runs the setup
+    client, db = mongo.start()
+    users = db['users']
+    audit = db['audit']
+    audit_writer = AuditWriter(audit, batch_size=AUDIT_BATCH_SIZE, flush_interval=AUDIT_FLUSH_INTERVAL,
+                               max_buffer=AUDIT_BUFFER_SIZE, spill_path=AUDIT_SPILL_PATH)
+    account_cache = AccountCache(users, max_size=ACCOUNT_CACHE_SIZE, ttl=ACCOUNT_CACHE_TTL, projection={OUTBOX_FIELD: 0})
+    if ACCOUNT_CACHE_WATCH:
+        account_cache.start_watching()
+    metrics.REGISTRY.register_stats('bot_account_cache', account_cache.stats)
+    metrics.REGISTRY.register_stats('bot_mongo', mongo.stats)
+    ledger = Ledger(users, audit_writer, account_cache)
+    audit_writer.start()
+    if CONVERSATION_STORE == 'memory':
+        conversations = MemoryStateStore(ttl=CONVERSATION_TTL)
+    else:
+        conversations = MongoStateStore(db['conversations'], ttl=CONVERSATION_TTL)
 
 def generate_markup(buttons):
     markup = InlineKeyboardMarkup()
@@ -86,64 +145,100 @@ def generate_markup(buttons):
         markup.add(InlineKeyboardButton(text, callback_data=callback_data))
     return markup
 
+INITIAL_BUTTONS = [
+    ("Check Balance", "check_balance"),
+    ("Deposit", "deposit"),
+    ("Withdraw", "withdraw"),
+    ("History", "history")
+]
+
 def generate_initial_markup():
-    buttons = [
-        ("Check Balance", "check_balance"),
-        ("Deposit", "deposit"),
-        ("Withdraw", "withdraw"),
-        ("History", "history")
-    ]
-    return generate_markup(buttons)
+    return generate_markup(INITIAL_BUTTONS)
+
+# The main menu never changes, so it is serialized once instead of on every message
+INITIAL_MARKUP = generate_initial_markup().to_json()
+
+CALLBACK_ACTIONS = {callback_data for _, callback_data in INITIAL_BUTTONS} | {'cancel_operation'}
+CALLBACK_PREFIXES = ('confirm_deposit', 'confirm_withdraw', 'history_older', 'history_newer')
+
+def callback_action(call):
+    # Amounts and cursors are stripped so the metric labels stay a small fixed set
+    for prefix in CALLBACK_PREFIXES:
+        if call.data.startswith(prefix + '_'):
+            return prefix
+    return call.data if call.data in CALLBACK_ACTIONS else 'other'
 
 @bot.message_handler(commands=['start'])
-def handle_start(message):
-    if not db_available:
-        bot.reply_to(message, "Oops, our database is experiencing instability. Please contact support.")
+@metrics.timed('handle_start')
+async def handle_start(message):
+    if not mongo.available:
+        sender.send(message.chat.id, "Oops, our database is experiencing instability. Please contact support.", reply_parameters=ReplyParameters(message.message_id))
         return
 
     chat_id = message.chat.id
-    user = users.find_one({'_id': chat_id})
+    await conversations.clear(chat_id)
+    user = await account_cache.get(chat_id)
     if not user:
-        users.insert_one({
+        user = {
             '_id': chat_id,
             'balance': 0,
             'last_transaction': None
-        })
-        logger.info(f"New user registered: {chat_id}")
-    bot.reply_to(message, "Welcome to the Bank Bot! What would you like to do?", reply_markup=generate_initial_markup())
+        }
+        await users.insert_one(user)
+        account_cache.put(chat_id, user)
+        logger.info("New user registered: %s", chat_id)
+    sender.send(chat_id, "Welcome to the Bank Bot! What would you like to do?", reply_markup=INITIAL_MARKUP, reply_parameters=ReplyParameters(message.message_id))
+
+@bot.message_handler(content_types=['text'])
+async def handle_text(message):
+    if not mongo.available:
+        return
+
+    conversation = await conversations.get(message.chat.id)
+    if conversation is None:
+        return
+    if conversation['state'] == AWAITING_DEPOSIT_AMOUNT:
+        await process_deposit_amount(message)
+    elif conversation['state'] == AWAITING_WITHDRAWAL_AMOUNT:
+        await process_withdrawal_amount(message)
 
 @bot.callback_query_handler(func=lambda call: True)
-def callback_query(call):
-    if not db_available:
-        bot.answer_callback_query(call.id, "Sorry, the service is temporarily unavailable. Please try again later.")
+@metrics.timed('callback_query', action=callback_action)
+async def callback_query(call):
+    if not mongo.available:
+        await bot.answer_callback_query(call.id, "Sorry, the service is temporarily unavailable. Please try again later.")
         return
 
     chat_id = call.message.chat.id
     if call.data == "check_balance":
-        check_balance(call.message)
+        await check_balance(call.message)
     elif call.data == "deposit":
-        start_deposit(call.message)
+        await start_deposit(call.message)
     elif call.data == "withdraw":
-        start_withdrawal(call.message)
+        await start_withdrawal(call.message)
     elif call.data.startswith("confirm_deposit_"):
         amount = float(call.data.split("_")[2])
-        confirm_deposit(call.message, amount)
+        await confirm_deposit(call.message, amount)
     elif call.data.startswith("confirm_withdraw_"):
         amount = float(call.data.split("_")[2])
-        confirm_withdrawal(call.message, amount)
+        await confirm_withdrawal(call.message, amount)
     elif call.data == "cancel_operation":
-        bot.send_message(chat_id, "Operation cancelled.", reply_markup=generate_initial_markup())
-        logger.info(f"Operation cancelled by user: {chat_id}")
+        await conversations.clear(chat_id)
+        sender.send(chat_id, "Operation cancelled.", reply_markup=INITIAL_MARKUP)
+        logger.info("Operation cancelled by user: %s", chat_id)
     elif call.data == "history":
-        show_history(call.message)
-
-def check_balance(message):
-    if not db_available:
-        bot.send_message(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
+        await show_history(call.message)
+    elif call.data.startswith("history_"):
+        _, direction, cursor = call.data.split("_", 2)
+        await show_history(call.message, direction, cursor)
+
+async def check_balance(message):
+    if not mongo.available:
+        sender.send(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
         return
 
     chat_id = message.chat.id
-    user = users.find_one({'_id': chat_id})
+    user = await account_cache.get(chat_id)
     if user:
         balance = user['balance']
         last_transaction = user['last_transaction']
@@ -154,25 +249,26 @@ def check_balance(message):
     else:
         response = "Sorry, we couldn't find your information. Please try again later."
     
-    bot.send_message(chat_id, response, reply_markup=generate_initial_markup())
-    logger.info(f"Balance checked for user: {chat_id}")
+    sender.send(chat_id, response, reply_markup=INITIAL_MARKUP)
+    logger.info("Balance checked for user: %s", chat_id)
 
-def start_deposit(message):
-    if not db_available:
-        bot.send_message(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
+async def start_deposit(message):
+    if not mongo.available:
+        sender.send(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
         return
 
-    bot.send_message(message.chat.id, "Please enter the amount you want to deposit:")
-    bot.register_next_step_handler(message, process_deposit_amount)
+    await conversations.set(message.chat.id, AWAITING_DEPOSIT_AMOUNT)
+    sender.send(message.chat.id, "Please enter the amount you want to deposit:")
 
-def process_deposit_amount(message):
+@metrics.timed('process_deposit_amount')
+async def process_deposit_amount(message):
     try:
         amount = float(message.text)
         if amount <= 0:
             raise ValueError("The amount must be greater than zero.")
         
         chat_id = message.chat.id
-        user = users.find_one({'_id': chat_id})
+        user = await account_cache.get(chat_id)
         current_balance = user['balance']
         
         buttons = [
@@ -180,68 +276,66 @@ def process_deposit_amount(message):
             ("Cancel", "cancel_operation")
         ]
         markup = generate_markup(buttons)
-        bot.send_message(chat_id, f"You want to deposit ${amount:.2f}. Your current balance is ${current_balance:.2f}. Confirm?", reply_markup=markup)
+        await conversations.set(chat_id, PENDING_CONFIRMATION, operation='deposit', amount=amount)
+        sender.send(chat_id, f"You want to deposit ${amount:.2f}. Your current balance is ${current_balance:.2f}. Confirm?", reply_markup=markup)
     except ValueError as e:
-        bot.send_message(message.chat.id, f"Invalid amount. Please try again.")
-        bot.register_next_step_handler(message, process_deposit_amount)
-
-def confirm_deposit(message, amount):
+        sender.send(message.chat.id, f"Invalid amount. Please try again.")
+
+async def take_pending_confirmation(chat_id, operation, amount):
+    # Popping the state makes a second click on the same Confirm button a no-op; the pop only
+    # matches this exact confirmation, so an old button cannot discard the one that is pending
+    if await conversations.pop(chat_id, PENDING_CONFIRMATION, operation=operation, amount=amount):
+        return True
+    sender.send(chat_id, "This operation has expired or was already processed.", reply_markup=INITIAL_MARKUP)
+    logger.warning("Stale %s confirmation: User %s, Amount $%.2f", operation, chat_id, amount)
+    return False
+
+@metrics.timed('confirm_deposit')
+async def confirm_deposit(message, amount):
     chat_id = message.chat.id
-    timestamp = datetime.now()
-    
-    user = users.find_one({'_id': chat_id})
-    previous_balance = user['balance']
-    
-    result = users.update_one(
-        {'_id': chat_id},
-        {
-            '$inc': {'balance': amount},
-            '$set': {
-                'last_transaction': {
-                    'type': 'deposit',
-                    'amount': amount,
-                    'date': timestamp.strftime("%d/%m/%Y %H:%M:%S")}}})
+    if not await take_pending_confirmation(chat_id, 'deposit', amount):
+        return
+
+    entry = await ledger.deposit(chat_id, amount)
     
-    if result.modified_count > 0:
-        updated_balance = previous_balance + amount
+    if entry:
+        previous_balance = entry['previous_balance']
+        updated_balance = entry['current_balance']
         response = (f"Deposit of ${amount:.2f} successful!\n"
                     f"Previous balance: ${previous_balance:.2f}\n"
                     f"Updated balance: ${updated_balance:.2f}\n"
-                    f"Transaction date and time: {timestamp.strftime('%d/%m/%Y %H:%M:%S')}")
-        bot.send_message(chat_id, response, reply_markup=generate_initial_markup())
-        logger.info(f"Deposit made: User {chat_id}, Amount ${amount:.2f}, Previous balance ${previous_balance:.2f}, New balance ${updated_balance:.2f}")
-        
-        # Register in audit
-        register_audit(chat_id, "deposit", amount, previous_balance, updated_balance)
+                    f"Transaction date and time: {entry['timestamp'].strftime('%d/%m/%Y %H:%M:%S')}")
+        sender.send(chat_id, response, reply_markup=INITIAL_MARKUP, priority=PRIORITY_TRANSACTION)
+        logger.info("Deposit made: User %s, Amount $%.2f, Previous balance $%.2f, New balance $%.2f", chat_id, amount, previous_balance, updated_balance)
     else:
-        bot.send_message(chat_id, "An error occurred while processing the deposit. Please try again.", reply_markup=generate_initial_markup())
-        logger.error(f"Failed to process deposit: User {chat_id}, Amount ${amount:.2f}")
+        sender.send(chat_id, "An error occurred while processing the deposit. Please try again.", reply_markup=INITIAL_MARKUP, priority=PRIORITY_TRANSACTION)
+        logger.error("Failed to process deposit: User %s, Amount $%.2f", chat_id, amount)
 
-def start_withdrawal(message):
-    if not db_available:
-        bot.send_message(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
+async def start_withdrawal(message):
+    if not mongo.available:
+        sender.send(message.chat.id, "Oops, our database is experiencing instability. Please contact support.")
         return
 
     chat_id = message.chat.id
-    user = users.find_one({'_id': chat_id})
+    user = await account_cache.get(chat_id)
     current_balance = user['balance']
 
-    bot.send_message(chat_id, f"Your current balance is ${current_balance:.2f}. Please enter the amount you want to withdraw:")
-    bot.register_next_step_handler(message, process_withdrawal_amount)
+    await conversations.set(chat_id, AWAITING_WITHDRAWAL_AMOUNT)
+    sender.send(chat_id, f"Your current balance is ${current_balance:.2f}. Please enter the amount you want to withdraw:")
 
-def process_withdrawal_amount(message):
+@metrics.timed('process_withdrawal_amount')
+async def process_withdrawal_amount(message):
     try:
         amount = float(message.text)
         if amount <= 0:
             raise ValueError("The amount must be greater than zero.")
         
         chat_id = message.chat.id
-        user = users.find_one({'_id': chat_id})
+        user = await account_cache.get(chat_id)
         current_balance = user['balance']
         
         if current_balance < amount:
-            bot.send_message(chat_id, f"Insufficient balance. Your current balance is ${current_balance:.2f}. Please enter a new withdrawal amount:")
-            bot.register_next_step_handler(message, process_withdrawal_amount)
+            sender.send(chat_id, f"Insufficient balance. Your current balance is ${current_balance:.2f}. Please enter a new withdrawal amount:")
             return
         
         buttons = [
@@ -249,63 +343,197 @@ def process_withdrawal_amount(message):
             ("Cancel", "cancel_operation")
         ]
         markup = generate_markup(buttons)
-        bot.send_message(chat_id, f"You want to withdraw ${amount:.2f}. Your current balance is ${current_balance:.2f}. After withdrawal, your balance will be ${current_balance - amount:.2f}. Confirm?", reply_markup=markup)
+        await conversations.set(chat_id, PENDING_CONFIRMATION, operation='withdrawal', amount=amount)
+        sender.send(chat_id, f"You want to withdraw ${amount:.2f}. Your current balance is ${current_balance:.2f}. After withdrawal, your balance will be ${current_balance - amount:.2f}. Confirm?", reply_markup=markup)
     except ValueError as e:
-        bot.send_message(message.chat.id, f"Invalid amount. Please try again.")
-        bot.register_next_step_handler(message, process_withdrawal_amount)
+        sender.send(message.chat.id, f"Invalid amount. Please try again.")
 
-def confirm_withdrawal(message, amount):
+@metrics.timed('confirm_withdrawal')
+async def confirm_withdrawal(message, amount):
     chat_id = message.chat.id
-    timestamp = datetime.now()
-    
-    user = users.find_one({'_id': chat_id})
-    previous_balance = user['balance']
-    
-    if previous_balance < amount:
-        bot.send_message(chat_id, f"Insufficient balance for withdrawal. Your current balance is ${previous_balance:.2f}.", reply_markup=generate_initial_markup())
-        logger.warning(f"Withdrawal attempt with insufficient balance: User {chat_id}, Amount ${amount:.2f}, Current balance ${previous_balance:.2f}")
+    if not await take_pending_confirmation(chat_id, 'withdrawal', amount):
         return
+
+    entry = await ledger.withdraw(chat_id, amount)
     
-    result = users.update_one(
-        {'_id': chat_id},
-        {
-            '$inc': {'balance': -amount},
-            '$set': {
-                'last_transaction': {
-                    'type': 'withdrawal',
-                    'amount': amount,
-                    'date': timestamp.strftime("%d/%m/%Y %H:%M:%S")}}})
-    
-    if result.modified_count > 0:
-        updated_balance = previous_balance - amount
+    if entry:
+        previous_balance = entry['previous_balance']
+        updated_balance = entry['current_balance']
         response = (f"Withdrawal of ${amount:.2f} successful!\n"
                     f"Previous balance: ${previous_balance:.2f}\n"
                     f"Updated balance: ${updated_balance:.2f}\n"
-                    f"Transaction date and time: {timestamp.strftime('%d/%m/%Y %H:%M:%S')}")
-        bot.send_message(chat_id, response, reply_markup=generate_initial_markup())
-        logger.info(f"Withdrawal made: User {chat_id}, Amount ${amount:.2f}, Previous balance ${previous_balance:.2f}, New balance ${updated_balance:.2f}")
-        
-        # Register in audit
-        register_audit(chat_id, "withdrawal", amount, previous_balance, updated_balance)
+                    f"Transaction date and time: {entry['timestamp'].strftime('%d/%m/%Y %H:%M:%S')}")
+        sender.send(chat_id, response, reply_markup=INITIAL_MARKUP, priority=PRIORITY_TRANSACTION)
+        logger.info("Withdrawal made: User %s, Amount $%.2f, Previous balance $%.2f, New balance $%.2f", chat_id, amount, previous_balance, updated_balance)
+        return
+    
+    # The conditional update matched nothing: either the balance is too low or the user is missing
+    account_cache.invalidate(chat_id)
+    user = await account_cache.get(chat_id)
+    if user:
+        sender.send(chat_id, f"Insufficient balance for withdrawal. Your current balance is ${user['balance']:.2f}.", reply_markup=INITIAL_MARKUP, priority=PRIORITY_TRANSACTION)
+        logger.warning("Withdrawal attempt with insufficient balance: User %s, Amount $%.2f, Current balance $%.2f", chat_id, amount, user['balance'])
     else:
-        bot.send_message(chat_id, "An error occurred while processing the withdrawal. Please try again.", reply_markup=generate_initial_markup())
-        logger.error(f"Failed to process withdrawal: User {chat_id}, Amount ${amount:.2f}")
+        sender.send(chat_id, "An error occurred while processing the withdrawal. Please try again.", reply_markup=INITIAL_MARKUP, priority=PRIORITY_TRANSACTION)
+        logger.error("Failed to process withdrawal: User %s, Amount $%.2f", chat_id, amount)
+
+EPOCH = datetime(1970, 1, 1)
 
-def show_history(message):
+def encode_history_cursor(transaction):
+    milliseconds = (transaction['timestamp'] - EPOCH) // timedelta(milliseconds=1)
+    return f"{milliseconds}_{transaction['_id']}"
+
+def decode_history_cursor(cursor):
+    milliseconds, object_id = cursor.split("_")
+    return EPOCH + timedelta(milliseconds=int(milliseconds)), ObjectId(object_id)
+
+@metrics.timed('show_history')
+async def show_history(message, direction=None, cursor=None):
     chat_id = message.chat.id
-    history = audit.find({'chat_id': chat_id}).sort('timestamp', -1).limit(10)  # Last 10 transactions
+    query = {'chat_id': chat_id}
+    sort_order = -1
+    if cursor:
+        # Keyset pagination over the (chat_id, timestamp, _id) index: each page is a single index range scan
+        timestamp, object_id = decode_history_cursor(cursor)
+        operator = '$lt' if direction == 'older' else '$gt'
+        query['$or'] = [{'timestamp': {operator: timestamp}},
+                        {'timestamp': timestamp, '_id': {operator: object_id}}]
+        if direction == 'newer':
+            sort_order = 1
+
+    # One extra record tells whether there is another page in the same direction
+    history = await audit.find(query).sort([('timestamp', sort_order), ('_id', sort_order)]).limit(HISTORY_PAGE_SIZE + 1).to_list()
+    # Confirmed transactions are not in audit until the audit writer has stored them. A chat's updates are
+    # always handled by the same process, so its writer has them, unless they were spilled and not replayed yet
+    pending = audit_writer.pending(chat_id)
+    if pending is None:
+        user = await users.find_one({'_id': chat_id}, {OUTBOX_FIELD: 1})
+        pending = user.get(OUTBOX_FIELD, []) if user else []
+    if cursor:
+        key = (timestamp, object_id)
+        if direction == 'older':
+            pending = [entry for entry in pending if (entry['timestamp'], entry['_id']) < key]
+        else:
+            pending = [entry for entry in pending if (entry['timestamp'], entry['_id']) > key]
+    if pending:
+        stored = {transaction['_id'] for transaction in history}
+        history += [entry for entry in pending if entry['_id'] not in stored]
+        history.sort(key=lambda transaction: (transaction['timestamp'], transaction['_id']), reverse=sort_order == -1)
+    has_more = len(history) > HISTORY_PAGE_SIZE
+    history = history[:HISTORY_PAGE_SIZE]
+    if direction == 'newer':
+        history.reverse()
     
-    if audit.count_documents({'chat_id': chat_id}) == 0:
-        bot.send_message(chat_id, "You don't have any transaction history yet.", reply_markup=generate_initial_markup())
+    if not history:
+        if cursor:
+            sender.send(chat_id, "There are no more transactions to show.", reply_markup=INITIAL_MARKUP)
+        else:
+            sender.send(chat_id, "You don't have any transaction history yet.", reply_markup=INITIAL_MARKUP)
         return
     
-    response = "Transaction history (last 10):\n\n"
+    response = f"Transaction history (last {HISTORY_PAGE_SIZE}):\n\n" if not cursor else "Transaction history:\n\n"
     for transaction in history:
         response += f"{transaction['timestamp'].strftime('%d/%m/%Y %H:%M:%S')} - {transaction['operation_type'].capitalize()} of ${transaction['amount']:.2f}\n"
         response += f"Previous balance: ${transaction['previous_balance']:.2f} | Current balance: ${transaction['current_balance']:.2f}\n\n"
     
-    bot.send_message(chat_id, response, reply_markup=generate_initial_markup())
+    if direction == 'newer':
+        has_older, has_newer = True, has_more
+    else:
+        has_older, has_newer = has_more, cursor is not None
+    
+    buttons = []
+    if has_older:
+        buttons.append(("Older", f"history_older_{encode_history_cursor(history[-1])}"))
+    if has_newer:
+        buttons.append(("Newer", f"history_newer_{encode_history_cursor(history[0])}"))
+    sender.send(chat_id, response, reply_markup=generate_markup(buttons + INITIAL_BUTTONS))
+
+async def process_update(update):
+    await bot.process_new_updates([update])
+
+async def poll_updates(dispatcher):
+    await bot.remove_webhook()
+    offset = None
+    while True:
+        await dispatcher.has_capacity.wait()
+        try:
+            updates = await bot.get_updates(offset=offset, timeout=POLLING_TIMEOUT)
+        except Exception as e:
+            logger.error("Error fetching updates: %s", e)
+            await asyncio.sleep(3)
+            continue
+
+        # Updates the dispatcher refuses are not acknowledged and get fetched again
+        for update in updates:
+            if not dispatcher.submit(update):
+                break
+            offset = update.update_id + 1
+
+async def start_services(metrics_port=METRICS_PORT):
+    global metrics_runner
+    connect_mongodb()
+    sender.start()
+    metrics.REGISTRY.register_stats('bot_sender', sender.stats)
+    if metrics_port:
+        metrics_runner = await metrics.start_metrics_server(METRICS_HOST, metrics_port)
+
+async def stop_services():
+    await sender.close(DRAIN_TIMEOUT)
+    if audit_writer:
+        await audit_writer.close()
+    if account_cache:
+        await account_cache.close()
+        logger.info("Account cache stats: %s", account_cache.stats())
+    await bot.close_session()
+    await mongo.close()
+    if metrics_runner:
+        await metrics_runner.cleanup()
+
+async def serve_worker(index, connection):
+    # The launcher serves METRICS_PORT itself, each worker the port after it plus its index
+    await start_services(METRICS_PORT + 1 + index if METRICS_PORT else 0)
+    dispatcher = ChatDispatcher(process_update, max_workers=MAX_CONCURRENT_UPDATES, max_pending=UPDATE_QUEUE_SIZE)
+    metrics.REGISTRY.register_stats('bot_dispatcher', dispatcher.stats)
+    logger.info("Worker %s started", index)
+    try:
+        await receive_updates(connection, dispatcher)
+    finally:
+        await dispatcher.drain(DRAIN_TIMEOUT)
+        await stop_services()
+
+def run_worker(index, connection):
+    # Workers are stopped by the launcher, not by the terminal's Ctrl+C
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    asyncio.run(serve_worker(index, connection))
+
+async def main():
+    global metrics_runner
+    asyncio.get_running_loop().add_signal_handler(signal.SIGTERM, asyncio.current_task().cancel)
+    if WORKER_PROCESSES > 1:
+        dispatcher = PartitionedDispatcher(WORKER_PROCESSES, run_worker, max_pending=UPDATE_QUEUE_SIZE)
+        if METRICS_PORT:
+            metrics_runner = await metrics.start_metrics_server(METRICS_HOST, METRICS_PORT)
+    else:
+        await start_services()
+        dispatcher = ChatDispatcher(process_update, max_workers=MAX_CONCURRENT_UPDATES, max_pending=UPDATE_QUEUE_SIZE)
+    metrics.REGISTRY.register_stats('bot_dispatcher', dispatcher.stats)
+    logger.info("Bot started in %s mode. Press Ctrl+C to stop.", RUN_MODE)
+    try:
+        if RUN_MODE == 'webhook':
+            await run_webhook(bot, dispatcher, WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_URL, WEBHOOK_SECRET)
+        else:
+            await poll_updates(dispatcher)
+    finally:
+        await dispatcher.drain(DRAIN_TIMEOUT)
+        if WORKER_PROCESSES > 1:
+            await bot.close_session()
+            if metrics_runner:
+                await metrics_runner.cleanup()
+        else:
+            await stop_services()
 
 if __name__ == '__main__':
-    logger.info("Bot started. Press Ctrl+C to stop.")
-    bot.polling(none_stop=True)
\ No newline at end of file
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
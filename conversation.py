@@ -0,0 +1,82 @@
+import time
+from datetime import datetime, timedelta
+
+
+AWAITING_DEPOSIT_AMOUNT = 'awaiting_deposit_amount'
+AWAITING_WITHDRAWAL_AMOUNT = 'awaiting_withdrawal_amount'
+PENDING_CONFIRMATION = 'pending_confirmation'
+
+
+class MemoryStateStore:
+    """Conversation states kept in process memory, for tests and single-process runs."""
+
+    def __init__(self, ttl=900):
+        self.ttl = ttl
+        self.states = {}
+
+    async def setup(self):
+        pass
+
+    async def get(self, chat_id):
+        entry = self.states.get(chat_id)
+        if entry is None:
+            return None
+        state, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self.states[chat_id]
+            return None
+        return state
+
+    async def set(self, chat_id, state, **data):
+        self.states[chat_id] = ({'state': state, **data}, time.monotonic() + self.ttl)
+
+    async def pop(self, chat_id, state, **data):
+        current = await self.get(chat_id)
+        if current is None or current != {'state': state, **data}:
+            return None
+        del self.states[chat_id]
+        return current
+
+    async def clear(self, chat_id):
+        self.states.pop(chat_id, None)
+
+
+class MongoStateStore:
+    """Conversation states stored in MongoDB, shared by every bot process.
+
+    Documents expire through a TTL index; reads also check `expires_at` because
+    MongoDB only removes expired documents once a minute.
+    """
+
+    def __init__(self, collection, ttl=900):
+        self.collection = collection
+        self.ttl = ttl
+
+    async def setup(self):
+        await self.collection.create_index('expires_at', expireAfterSeconds=0)
+
+    async def get(self, chat_id):
+        document = await self.collection.find_one({'_id': chat_id, 'expires_at': {'$gt': datetime.utcnow()}})
+        return self.to_state(document)
+
+    async def set(self, chat_id, state, **data):
+        await self.collection.replace_one(
+            {'_id': chat_id},
+            {'state': state, **data, 'expires_at': datetime.utcnow() + timedelta(seconds=self.ttl)},
+            upsert=True)
+
+    async def pop(self, chat_id, state, **data):
+        document = await self.collection.find_one_and_delete(
+            {'_id': chat_id, 'state': state, **data, 'expires_at': {'$gt': datetime.utcnow()}})
+        return self.to_state(document)
+
+    async def clear(self, chat_id):
+        await self.collection.delete_one({'_id': chat_id})
+
+    @staticmethod
+    def to_state(document):
+        if document is None:
+            return None
+        document.pop('_id')
+        document.pop('expires_at')
+        return document
@@ -0,0 +1,111 @@
+import asyncio
+import logging
+from collections import deque
+
+
+logger = logging.getLogger(__name__)
+
+
+def get_update_chat_id(update):
+    if update.message:
+        return update.message.chat.id
+    if update.edited_message:
+        return update.edited_message.chat.id
+    if update.callback_query:
+        if update.callback_query.message:
+            return update.callback_query.message.chat.id
+        return update.callback_query.from_user.id
+    return None
+
+
+class ChatDispatcher:
+    """Runs updates of different chats concurrently and updates of the same chat in order.
+
+    At most `max_workers` updates are processed at once and at most `max_pending`
+    updates (queued or running) are held; `submit` refuses updates beyond that.
+    """
+
+    def __init__(self, process_update, max_workers=100, max_pending=1000):
+        self.process_update = process_update
+        self.max_pending = max_pending
+        self.slots = asyncio.Semaphore(max_workers)
+        self.has_capacity = asyncio.Event()
+        self.has_capacity.set()
+        self.chat_queues = {}
+        self.tasks = set()
+        self.pending = 0
+        self.in_flight = 0
+        self.pending_high_water = 0
+        self.received = 0
+        self.rejected = 0
+        self.processed = 0
+        self.failed = 0
+
+    def submit(self, update):
+        if self.pending >= self.max_pending:
+            self.rejected += 1
+            return False
+
+        self.received += 1
+        self.pending += 1
+        self.pending_high_water = max(self.pending_high_water, self.pending)
+        if self.pending >= self.max_pending:
+            self.has_capacity.clear()
+
+        key = get_update_chat_id(update)
+        if key is None:
+            key = ('update', update.update_id)
+
+        queue = self.chat_queues.get(key)
+        if queue is not None:
+            queue.append(update)
+            return True
+
+        self.chat_queues[key] = deque([update])
+        task = asyncio.create_task(self.run_chat(key))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+        return True
+
+    async def run_chat(self, key):
+        queue = self.chat_queues[key]
+        try:
+            while queue:
+                update = queue.popleft()
+                async with self.slots:
+                    self.in_flight += 1
+                    try:
+                        await self.process_update(update)
+                        self.processed += 1
+                    except Exception as e:
+                        self.failed += 1
+                        logger.error("Error processing update %s: %s", update.update_id, e)
+                    finally:
+                        self.in_flight -= 1
+                        self.pending -= 1
+                        if self.pending < self.max_pending:
+                            self.has_capacity.set()
+        finally:
+            del self.chat_queues[key]
+
+    async def drain(self, timeout=None):
+        logger.info("Draining %s pending updates", self.pending)
+        try:
+            async with asyncio.timeout(timeout):
+                while self.tasks:
+                    await asyncio.gather(*self.tasks)
+        except TimeoutError:
+            logger.warning("Drain timed out with %s updates still pending", self.pending)
+
+    def stats(self):
+        return {
+            'received': self.received,
+            'rejected': self.rejected,
+            'processed': self.processed,
+            'failed': self.failed,
+            'pending': self.pending,
+            'in_flight': self.in_flight,
+            'max_pending': self.max_pending,
+            'pending_high_water': self.pending_high_water,
+            'active_chats': len(self.chat_queues),
+        }
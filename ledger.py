@@ -0,0 +1,81 @@
+import logging
+from collections import defaultdict
+from datetime import datetime
+from bson import ObjectId
+from pymongo import ReturnDocument, UpdateOne
+
+
+logger = logging.getLogger(__name__)
+
+OUTBOX_FIELD = 'audit_outbox'
+
+
+class Ledger:
+    """Moves money with a single conditional write per operation.
+
+    The balance change, `last_transaction` and the audit record are written to the
+    user document in one atomic update; the audit record sits in the document's
+    outbox until the audit writer has stored it in the `audit` collection.
+    """
+
+    def __init__(self, users, audit_writer, account_cache=None):
+        self.users = users
+        self.audit_writer = audit_writer
+        self.account_cache = account_cache
+        audit_writer.on_written = self.clear_outbox
+
+    async def deposit(self, chat_id, amount):
+        return await self.apply(chat_id, 'deposit', amount)
+
+    async def withdraw(self, chat_id, amount):
+        return await self.apply(chat_id, 'withdrawal', -amount, {'balance': {'$gte': amount}})
+
+    async def apply(self, chat_id, operation_type, delta, condition=None):
+        timestamp = datetime.now()
+        new_balance = {'$add': ['$balance', delta]}
+        record = {
+            '_id': ObjectId(),
+            'chat_id': chat_id,
+            'operation_type': operation_type,
+            'amount': abs(delta),
+            'previous_balance': '$balance',
+            'current_balance': new_balance,
+            'timestamp': timestamp
+        }
+        # A pipeline update evaluates every '$balance' against the pre-image, so the
+        # record gets the exact before/after balances of this write
+        update = [{'$set': {
+            'balance': new_balance,
+            'last_transaction': {
+                'type': operation_type,
+                'amount': abs(delta),
+                'date': timestamp.strftime("%d/%m/%Y %H:%M:%S")},
+            OUTBOX_FIELD: {'$concatArrays': [{'$ifNull': [f'${OUTBOX_FIELD}', []]}, [record]]}}}]
+
+        user = await self.users.find_one_and_update(
+            {'_id': chat_id, **(condition or {})},
+            update,
+            projection={'balance': 1, 'last_transaction': 1, OUTBOX_FIELD: {'$slice': -1}},
+            return_document=ReturnDocument.AFTER)
+        if user is None:
+            return None
+
+        entry = user.pop(OUTBOX_FIELD)[-1]
+        if self.account_cache:
+            self.account_cache.put(chat_id, user)
+        self.audit_writer.add(dict(entry))
+        return entry
+
+    async def clear_outbox(self, records):
+        ids_by_chat = defaultdict(list)
+        for record in records:
+            ids_by_chat[record['chat_id']].append(record['_id'])
+        await self.users.bulk_write([
+            UpdateOne({'_id': chat_id}, {'$pull': {OUTBOX_FIELD: {'_id': {'$in': ids}}}})
+            for chat_id, ids in ids_by_chat.items()], ordered=False)
+
+    async def relay_pending(self):
+        # Outbox entries left behind by a crash are handed to the audit writer again
+        async for user in self.users.find({f'{OUTBOX_FIELD}.0': {'$exists': True}}, {OUTBOX_FIELD: 1}):
+            for entry in user[OUTBOX_FIELD]:
+                self.audit_writer.add(entry)
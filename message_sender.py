@@ -0,0 +1,200 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+from collections import deque
+from telebot.asyncio_helper import ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_TRANSACTION = 0
+PRIORITY_NORMAL = 1
+
+TOO_MANY_REQUESTS = 429
+
+
+class TokenBucket:
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+
+    def wait_time(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+        if self.tokens >= 1:
+            return 0
+        return (1 - self.tokens) / self.rate
+
+    def consume(self):
+        self.tokens -= 1
+
+    def is_full(self, now):
+        return self.wait_time(now) == 0 and self.tokens >= self.capacity
+
+
+class ChatOutbox:
+    def __init__(self, rate, burst):
+        self.messages = deque()
+        self.bucket = TokenBucket(rate, burst)
+        self.blocked_until = 0
+        self.scheduled = False
+        self.sending = False
+
+
+class MessageSender:
+    """Queues outgoing messages and sends them within Telegram's flood limits.
+
+    Each chat is limited by its own token bucket and all chats share a global one.
+    Messages of a chat go out in the order they were queued; among chats that are
+    ready, the one whose next message has the lowest priority value goes first.
+    A 429 answer pauses the chat for the `retry_after` Telegram asks for.
+    """
+
+    def __init__(self, bot, global_rate=30, chat_rate=1, chat_burst=3, max_concurrency=50, max_retries=5):
+        self.bot = bot
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.slots = asyncio.Semaphore(max_concurrency)
+        self.chats = {}
+        self.ready = []
+        self.delayed = []
+        self.sequence = itertools.count()
+        self.wakeup = asyncio.Event()
+        self.tasks = set()
+        self.task = None
+        self.pruned_at = time.monotonic()
+        self.queued = 0
+        self.sent = 0
+        self.failed = 0
+        self.retried = 0
+        self.rate_limited = 0
+
+    def start(self):
+        self.task = asyncio.create_task(self.run())
+
+    def send(self, chat_id, text, priority=PRIORITY_NORMAL, **kwargs):
+        chat = self.chats.get(chat_id)
+        if chat is None:
+            chat = self.chats[chat_id] = ChatOutbox(self.chat_rate, self.chat_burst)
+        chat.messages.append({'priority': priority, 'text': text, 'kwargs': kwargs, 'attempts': 0})
+        self.queued += 1
+        if not chat.scheduled and not chat.sending:
+            self.schedule(chat_id, chat)
+
+    def schedule(self, chat_id, chat):
+        now = time.monotonic()
+        ready_at = max(now + chat.bucket.wait_time(now), chat.blocked_until)
+        chat.scheduled = True
+        if ready_at <= now:
+            heapq.heappush(self.ready, (chat.messages[0]['priority'], next(self.sequence), chat_id))
+        else:
+            heapq.heappush(self.delayed, (ready_at, next(self.sequence), chat_id))
+        self.wakeup.set()
+
+    async def run(self):
+        while True:
+            now = time.monotonic()
+            while self.delayed and self.delayed[0][0] <= now:
+                _, sequence, chat_id = heapq.heappop(self.delayed)
+                heapq.heappush(self.ready, (self.chats[chat_id].messages[0]['priority'], sequence, chat_id))
+
+            if now - self.pruned_at > 60:
+                self.prune(now)
+
+            if not self.ready:
+                timeout = self.delayed[0][0] - now if self.delayed else None
+                self.wakeup.clear()
+                try:
+                    async with asyncio.timeout(timeout):
+                        await self.wakeup.wait()
+                except TimeoutError:
+                    pass
+                continue
+
+            wait = self.global_bucket.wait_time(now)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+
+            await self.slots.acquire()
+            _, _, chat_id = heapq.heappop(self.ready)
+            chat = self.chats[chat_id]
+            chat.scheduled = False
+            chat.sending = True
+            self.global_bucket.consume()
+            chat.bucket.consume()
+            task = asyncio.create_task(self.deliver(chat_id, chat, chat.messages.popleft()))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+
+    async def deliver(self, chat_id, chat, message):
+        try:
+            await self.bot.send_message(chat_id, message['text'], **message['kwargs'])
+            self.sent += 1
+        except ApiTelegramException as e:
+            if e.error_code == TOO_MANY_REQUESTS:
+                retry_after = e.result_json.get('parameters', {}).get('retry_after', 1)
+                logger.warning("Rate limited by Telegram for chat %s, retrying in %ss", chat_id, retry_after)
+                self.rate_limited += 1
+                chat.blocked_until = time.monotonic() + retry_after
+                chat.messages.appendleft(message)
+            else:
+                logger.error("Failed to send message to chat %s: %s", chat_id, e)
+                self.failed += 1
+        except Exception as e:
+            message['attempts'] += 1
+            if message['attempts'] < self.max_retries:
+                backoff = min(2 ** message['attempts'], 30)
+                logger.warning("Error sending message to chat %s, retrying in %ss: %s", chat_id, backoff, e)
+                self.retried += 1
+                chat.blocked_until = time.monotonic() + backoff
+                chat.messages.appendleft(message)
+            else:
+                logger.error("Giving up sending message to chat %s after %s attempts: %s", chat_id, message['attempts'], e)
+                self.failed += 1
+        finally:
+            chat.sending = False
+            self.slots.release()
+            if chat.messages:
+                self.schedule(chat_id, chat)
+
+    def prune(self, now):
+        # Idle chats are kept until their bucket refills so their rate limit survives between messages
+        for chat_id in [chat_id for chat_id, chat in self.chats.items()
+                        if not chat.messages and not chat.sending and chat.bucket.is_full(now)]:
+            del self.chats[chat_id]
+        self.pruned_at = now
+
+    def pending(self):
+        return sum(len(chat.messages) for chat in self.chats.values()) + len(self.tasks)
+
+    async def close(self, timeout=None):
+        try:
+            async with asyncio.timeout(timeout):
+                while self.pending():
+                    await asyncio.sleep(0.05)
+        except TimeoutError:
+            logger.warning("Message sender stopped with %s messages still pending", self.pending())
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+
+    def stats(self):
+        return {
+            'queued': self.queued,
+            'sent': self.sent,
+            'failed': self.failed,
+            'retried': self.retried,
+            'rate_limited': self.rate_limited,
+            'pending': self.pending(),
+            'chats': len(self.chats),
+        }
@@ -0,0 +1,219 @@
+import bisect
+import functools
+import logging
+import time
+from aiohttp import web
+from pymongo import monitoring
+from telebot import asyncio_helper
+from telebot.asyncio_helper import ApiException, ApiTelegramException
+
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds; fine enough at the low end to separate a cached read from a Mongo round trip
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def register_stats(self, prefix, stats):
+        """Exports every numeric value of the dict returned by `stats()` as a gauge `<prefix>_<key>`."""
+        self.collectors.append((prefix, stats))
+
+    def unregister_stats(self, prefix):
+        self.collectors = [(name, stats) for name, stats in self.collectors if name != prefix]
+
+    def render(self):
+        lines = []
+        for metric in self.metrics:
+            lines += metric.render()
+        for prefix, stats in self.collectors:
+            try:
+                values = stats()
+            except Exception as e:
+                logger.error("Error collecting %s stats: %s", prefix, e)
+                continue
+            for key, value in values.items():
+                if isinstance(value, (int, float)) and not isinstance(value, bool):
+                    lines.append(f'# TYPE {prefix}_{key} gauge')
+                    lines.append(f'{prefix}_{key} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+def format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in pairs)
+    return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(pairs, escaped)) + '}'
+
+
+class Counter:
+    def __init__(self, name, documentation, labelnames=(), registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.values = {}
+        registry.register(self)
+
+    def inc(self, *labels, amount=1):
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, *labels):
+        return self.values.get(labels, 0)
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for labels, value in sorted(self.values.items()):
+            lines.append(f'{self.name}{format_labels(self.labelnames, labels)} {value}')
+        return lines
+
+
+class Histogram:
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS, registry=REGISTRY):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self.series = {}
+        registry.register(self)
+
+    def observe(self, value, *labels):
+        series = self.series.get(labels)
+        if series is None:
+            # Per-bucket counts plus one overflow slot, then the running sum
+            series = self.series[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+
+    def count(self, *labels):
+        series = self.series.get(labels)
+        return sum(series[0]) if series else 0
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, [("le", bound)])} {cumulative}')
+            cumulative += counts[-1]
+            lines.append(f'{self.name}_bucket{format_labels(self.labelnames, labels, [("le", "+Inf")])} {cumulative}')
+            lines.append(f'{self.name}_sum{format_labels(self.labelnames, labels)} {total}')
+            lines.append(f'{self.name}_count{format_labels(self.labelnames, labels)} {cumulative}')
+        return lines
+
+
+HANDLER_SECONDS = Histogram('bot_handler_seconds', "Time spent in bot handlers, including their Mongo calls.",
+                            ('handler', 'action'))
+HANDLER_ERRORS = Counter('bot_handler_errors_total', "Handler calls that raised an exception.", ('handler', 'action'))
+
+MONGO_COMMAND_SECONDS = Histogram('bot_mongo_command_seconds', "MongoDB command round trips as seen by the driver.",
+                                  ('command',))
+MONGO_COMMAND_ERRORS = Counter('bot_mongo_command_errors_total', "MongoDB commands that failed.", ('command',))
+
+TELEGRAM_REQUEST_SECONDS = Histogram('bot_telegram_request_seconds', "Bot API request round trips.", ('method',))
+TELEGRAM_REQUESTS = Counter('bot_telegram_requests_total', "Bot API requests by outcome.", ('method', 'outcome'))
+TELEGRAM_RATE_LIMITED = Counter('bot_telegram_rate_limited_total', "Bot API requests answered with 429.", ('method',))
+
+TOO_MANY_REQUESTS = 429
+
+
+def timed(handler, action=None):
+    """Records the duration and failures of an async handler.
+
+    `action`, if given, is called with the handler's arguments and returns the
+    value of the `action` label, e.g. the button that was pressed.
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            label = action(*args, **kwargs) if action else ''
+            started = time.perf_counter()
+            try:
+                return await function(*args, **kwargs)
+            except Exception:
+                HANDLER_ERRORS.inc(handler, label)
+                raise
+            finally:
+                HANDLER_SECONDS.observe(time.perf_counter() - started, handler, label)
+        return wrapper
+    return decorator
+
+
+class MongoCommandListener(monitoring.CommandListener):
+    """Feeds the driver's command monitoring events into the Mongo metrics."""
+
+    def started(self, event):
+        pass
+
+    def succeeded(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+
+    def failed(self, event):
+        MONGO_COMMAND_SECONDS.observe(event.duration_micros / 1e6, event.command_name)
+        MONGO_COMMAND_ERRORS.inc(event.command_name)
+
+
+def instrument_telegram_requests():
+    """Times and counts every Bot API call by wrapping the helper all of them go through.
+
+    The `method` label is the Bot API method name (sendMessage, answerCallbackQuery,
+    getUpdates, setWebhook, ...). Safe to call more than once.
+    """
+    process_request = asyncio_helper._process_request
+    if getattr(process_request, 'instrumented', False):
+        return
+
+    @functools.wraps(process_request)
+    async def wrapper(token, url, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            result = await process_request(token, url, *args, **kwargs)
+        except ApiTelegramException as e:
+            if e.error_code == TOO_MANY_REQUESTS:
+                TELEGRAM_RATE_LIMITED.inc(url)
+                TELEGRAM_REQUESTS.inc(url, 'rate_limited')
+            else:
+                TELEGRAM_REQUESTS.inc(url, 'api_error')
+            raise
+        except ApiException:
+            TELEGRAM_REQUESTS.inc(url, 'api_error')
+            raise
+        except Exception:
+            TELEGRAM_REQUESTS.inc(url, 'network_error')
+            raise
+        finally:
+            TELEGRAM_REQUEST_SECONDS.observe(time.perf_counter() - started, url)
+        TELEGRAM_REQUESTS.inc(url, 'ok')
+        return result
+
+    wrapper.instrumented = True
+    asyncio_helper._process_request = wrapper
+
+
+async def show_metrics(request):
+    return web.Response(body=REGISTRY.render().encode(), headers={'Content-Type': CONTENT_TYPE})
+
+
+async def start_metrics_server(host, port):
+    """Serves the registry at GET /metrics; returns the runner to clean up on shutdown."""
+    app = web.Application()
+    app.router.add_get('/metrics', show_metrics)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info("Metrics available at http://%s:%s/metrics", host, port)
+    return runner
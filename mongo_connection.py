@@ -0,0 +1,122 @@
+import asyncio
+import logging
+from pymongo import AsyncMongoClient
+from pymongo.errors import PyMongoError
+
+
+logger = logging.getLogger(__name__)
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class MongoConnectionManager:
+    """Owns the MongoDB client and a circuit breaker fed by a background health probe.
+
+    `start` creates the client without waiting for the server, so the bot starts
+    taking updates right away. The probe pings the server every `probe_interval`
+    seconds. After `failure_threshold` failed pings in a row the breaker opens.
+    The first successful ping after that half-opens it, and the next one closes it.
+    Handlers read `available`, which does no I/O. The first successful ping also
+    runs `setup(db)` (collections, indexes, crash recovery). Until setup has
+    succeeded once, the database counts as unavailable.
+    """
+
+    def __init__(self, uri, db_name, setup=None, probe_interval=5.0, probe_timeout=2.0, failure_threshold=2,
+                 client_factory=AsyncMongoClient, **client_options):
+        self.uri = uri
+        self.db_name = db_name
+        self.setup = setup
+        self.probe_interval = probe_interval
+        self.probe_timeout = probe_timeout
+        self.failure_threshold = failure_threshold
+        self.client_factory = client_factory
+        self.client_options = client_options
+        self.client = None
+        self.db = None
+        self.state = OPEN
+        self.ready = False
+        self.failures = 0
+        self.probes = 0
+        self.probe_failures = 0
+        self.trips = 0
+        self.task = None
+
+    @property
+    def available(self):
+        return self.ready and self.state != OPEN
+
+    def start(self):
+        self.client = self.client_factory(self.uri, **self.client_options)
+        self.db = self.client[self.db_name]
+        self.task = asyncio.create_task(self.run())
+        return self.client, self.db
+
+    async def run(self):
+        while True:
+            await self.probe()
+            await asyncio.sleep(self.probe_interval)
+
+    async def probe(self):
+        self.probes += 1
+        try:
+            async with asyncio.timeout(self.probe_timeout):
+                await self.client.admin.command('ping')
+        except (PyMongoError, TimeoutError) as e:
+            self.probe_failures += 1
+            self.record_failure(e)
+            return
+
+        if self.ready:
+            self.record_success()
+            return
+        try:
+            if self.setup:
+                await self.setup(self.db)
+        except Exception as e:
+            # Setup is retried after the next successful ping
+            logger.error("MongoDB setup failed: %s", e)
+            self.record_failure(e)
+            return
+        self.ready = True
+        self.state = CLOSED
+        self.failures = 0
+        logger.info("Connected to MongoDB, database '%s' is ready", self.db_name)
+
+    def record_failure(self, error):
+        self.failures += 1
+        if self.state == HALF_OPEN or (self.state == CLOSED and self.failures >= self.failure_threshold):
+            self.state = OPEN
+            self.trips += 1
+            logger.error("MongoDB unreachable, opening the circuit breaker: %s", error)
+        elif self.state == OPEN and self.failures == 1:
+            logger.error("MongoDB unreachable: %s", error)
+
+    def record_success(self):
+        self.failures = 0
+        if self.state == OPEN:
+            self.state = HALF_OPEN
+            logger.info("MongoDB reachable again, circuit breaker half-open")
+        elif self.state == HALF_OPEN:
+            self.state = CLOSED
+            logger.info("MongoDB healthy, circuit breaker closed")
+
+    async def close(self):
+        if self.task:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+        if self.client:
+            await self.client.close()
+
+    def stats(self):
+        return {
+            'state': self.state,
+            'available': int(self.available),
+            'probes': self.probes,
+            'probe_failures': self.probe_failures,
+            'trips': self.trips,
+        }
@@ -0,0 +1,397 @@
+"""Reconciles account balances against the audit trail and exports statements.
+
+    python reconciliation.py run [--interval 300] [--rebuild]
+    python reconciliation.py export --from 2026-01-01 --to 2026-01-31 [--chat-id 123] [--output statement.csv]
+"""
+import argparse
+import asyncio
+import csv
+import logging
+import os
+import sys
+from datetime import datetime, timedelta, timezone
+from bson import ObjectId
+from dotenv import load_dotenv
+from pymongo import AsyncMongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
+from ledger import OUTBOX_FIELD
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+
+logger = logging.getLogger(__name__)
+
+DUPLICATE_KEY_ERROR = 11000
+CHECKPOINT_ID = 'audit'
+LOWEST_OBJECT_ID = ObjectId(b'\x00' * 12)
+# Balances are floats; differences under half a cent are rounding, not breaks
+TOLERANCE = 0.005
+SIGNS = {'deposit': 1, 'withdrawal': -1}
+AUDIT_PROJECTION = {'chat_id': 1, 'operation_type': 1, 'amount': 1, 'previous_balance': 1,
+                    'current_balance': 1, 'timestamp': 1}
+STATEMENT_COLUMNS = ['timestamp', 'chat_id', 'operation_type', 'amount', 'previous_balance', 'current_balance', 'audit_id']
+
+
+def new_account():
+    return {'balance': 0.0, 'deposits': 0.0, 'withdrawals': 0.0, 'transactions': 0, 'breaks': 0, 'last_timestamp': None}
+
+
+def new_snapshot(opening_balance):
+    return {'opening_balance': opening_balance, 'closing_balance': opening_balance,
+            'deposits': 0.0, 'withdrawals': 0.0, 'transactions': 0}
+
+
+def snapshot_id(record):
+    return f"{record['chat_id']}:{record['timestamp']:%Y-%m-%d}"
+
+
+def make_break(record, kind, expected, found):
+    return {'_id': f"{record['_id']}:{kind}", 'chat_id': record['chat_id'], 'audit_id': record['_id'], 'kind': kind,
+            'expected': expected, 'found': found, 'timestamp': record['timestamp']}
+
+
+def analyze(records, opening_balances):
+    """Walks records sorted by (chat_id, timestamp, _id) and checks every balance chain.
+
+    Each record must start from the balance the previous one ended with, and move
+    it by exactly its amount. Returns this batch's per-chat changes, per-(chat, day)
+    snapshot changes and the breaks found.
+    """
+    accounts, snapshots, breaks = {}, {}, []
+    for record in records:
+        chat_id = record['chat_id']
+        account = accounts.get(chat_id)
+        if account is None:
+            account = accounts[chat_id] = new_account()
+            account['balance'] = opening_balances.get(chat_id, 0.0)
+
+        if abs(record['previous_balance'] - account['balance']) > TOLERANCE:
+            breaks.append(make_break(record, 'chain', account['balance'], record['previous_balance']))
+            account['breaks'] += 1
+        sign = SIGNS.get(record['operation_type'], 0)
+        expected = record['previous_balance'] + sign * record['amount']
+        if abs(record['current_balance'] - expected) > TOLERANCE:
+            breaks.append(make_break(record, 'amount', expected, record['current_balance']))
+            account['breaks'] += 1
+
+        deposit = record['amount'] if sign > 0 else 0.0
+        withdrawal = record['amount'] if sign < 0 else 0.0
+        account['balance'] = record['current_balance']
+        account['deposits'] += deposit
+        account['withdrawals'] += withdrawal
+        account['transactions'] += 1
+        account['last_timestamp'] = record['timestamp']
+
+        timestamp = record['timestamp']
+        key = (chat_id, datetime(timestamp.year, timestamp.month, timestamp.day))
+        snapshot = snapshots.get(key)
+        if snapshot is None:
+            snapshot = snapshots[key] = new_snapshot(record['previous_balance'])
+        snapshot['closing_balance'] = record['current_balance']
+        snapshot['deposits'] += deposit
+        snapshot['withdrawals'] += withdrawal
+        snapshot['transactions'] += 1
+    return accounts, snapshots, breaks
+
+
+def analyze_vectorized(records, opening_balances):
+    """Same result as `analyze`, with the checks and totals computed by numpy over the whole batch."""
+    count = len(records)
+    chats = np.fromiter((record['chat_id'] for record in records), np.int64, count)
+    days = np.fromiter((record['timestamp'].toordinal() for record in records), np.int64, count)
+    previous = np.fromiter((record['previous_balance'] for record in records), np.float64, count)
+    current = np.fromiter((record['current_balance'] for record in records), np.float64, count)
+    amounts = np.fromiter((record['amount'] for record in records), np.float64, count)
+    signs = np.fromiter((SIGNS.get(record['operation_type'], 0) for record in records), np.float64, count)
+
+    # Records are sorted by chat, so every chat, and every day within it, is a contiguous run
+    chat_changed = np.r_[True, chats[1:] != chats[:-1]]
+    chat_starts = np.flatnonzero(chat_changed)
+    chat_ends = np.r_[chat_starts[1:], count] - 1
+    day_starts = np.flatnonzero(chat_changed | np.r_[True, days[1:] != days[:-1]])
+    day_ends = np.r_[day_starts[1:], count] - 1
+
+    carried = np.empty(count)
+    carried[1:] = current[:-1]
+    carried[chat_starts] = [opening_balances.get(int(chat_id), 0.0) for chat_id in chats[chat_starts]]
+    expected = previous + signs * amounts
+    chain_breaks = np.abs(previous - carried) > TOLERANCE
+    amount_breaks = np.abs(current - expected) > TOLERANCE
+
+    deposits = np.where(signs > 0, amounts, 0.0)
+    withdrawals = np.where(signs < 0, amounts, 0.0)
+    broken = chain_breaks.astype(np.int64) + amount_breaks
+
+    breaks = []
+    for index in np.flatnonzero(chain_breaks | amount_breaks):
+        record = records[index]
+        if chain_breaks[index]:
+            breaks.append(make_break(record, 'chain', float(carried[index]), record['previous_balance']))
+        if amount_breaks[index]:
+            breaks.append(make_break(record, 'amount', float(expected[index]), record['current_balance']))
+
+    accounts = {}
+    for start, end, chat_deposits, chat_withdrawals, chat_breaks in zip(
+            chat_starts, chat_ends, np.add.reduceat(deposits, chat_starts),
+            np.add.reduceat(withdrawals, chat_starts), np.add.reduceat(broken, chat_starts)):
+        accounts[int(chats[start])] = {
+            'balance': float(current[end]), 'deposits': float(chat_deposits), 'withdrawals': float(chat_withdrawals),
+            'transactions': int(end - start + 1), 'breaks': int(chat_breaks),
+            'last_timestamp': records[end]['timestamp']}
+
+    snapshots = {}
+    for start, end, day_deposits, day_withdrawals in zip(
+            day_starts, day_ends, np.add.reduceat(deposits, day_starts), np.add.reduceat(withdrawals, day_starts)):
+        snapshots[(int(chats[start]), datetime.fromordinal(int(days[start])))] = {
+            'opening_balance': float(previous[start]), 'closing_balance': float(current[end]),
+            'deposits': float(day_deposits), 'withdrawals': float(day_withdrawals),
+            'transactions': int(end - start + 1)}
+    return accounts, snapshots, breaks
+
+
+class Reconciler:
+    """Checks new audit records incrementally and materializes running totals and daily snapshots.
+
+    Audit records are read in `_id` order from the last checkpoint. Every record
+    waits in its user's outbox until it is stored in `audit`, even while it sits in
+    the audit writer's spill file. So a run stops below the oldest outbox entry
+    that is not in `audit` yet, and no record can show up behind the checkpoint
+    later. Records newer than
+    `settle_seconds` are left as well, to cover those whose transaction is still
+    in flight. Every batch updates `reconciliation_accounts` (running
+    totals per chat) and `balance_snapshots` (one document per chat and day). It
+    records breaks in `reconciliation_breaks` and then moves the checkpoint forward.
+    Each document stores the last batch applied to it, and only takes the
+    records after that batch. A batch repeated after a crash, even one that
+    stopped between two of these writes, therefore cannot be counted twice.
+    """
+
+    def __init__(self, db, batch_size=5000, settle_seconds=300, vectorized=None):
+        self.audit = db['audit']
+        self.users = db['users']
+        self.accounts = db['reconciliation_accounts']
+        self.snapshots = db['balance_snapshots']
+        self.breaks = db['reconciliation_breaks']
+        self.checkpoints = db['reconciliation_checkpoints']
+        self.batch_size = batch_size
+        self.settle_seconds = settle_seconds
+        self.vectorized = np is not None if vectorized is None else vectorized
+        if self.vectorized and np is None:
+            raise RuntimeError("Vectorized reconciliation needs numpy")
+
+    async def setup(self):
+        await self.users.create_index(f'{OUTBOX_FIELD}._id')
+        await self.snapshots.create_index([('chat_id', 1), ('day', 1)])
+        await self.breaks.create_index([('chat_id', 1), ('timestamp', 1)])
+
+    async def rebuild(self):
+        for collection in (self.accounts, self.snapshots, self.breaks, self.checkpoints):
+            await collection.drop()
+        logger.info("Reconciliation state cleared, the next run starts from the first audit record")
+
+    async def run(self):
+        checkpoint = await self.checkpoints.find_one({'_id': CHECKPOINT_ID})
+        horizon = ObjectId.from_datetime(datetime.now(timezone.utc) - timedelta(seconds=self.settle_seconds))
+        pending = await self.oldest_pending_id()
+        if pending is not None and pending < horizon:
+            logger.info("Audit records since %s are not written yet, reconciling up to them", pending.generation_time)
+            horizon = pending
+        query = {'_id': {'$lt': horizon}}
+        if checkpoint:
+            query['_id']['$gt'] = checkpoint['last_id']
+
+        totals = {'records': 0, 'batches': 0, 'breaks': 0}
+        batch = []
+        async for record in self.audit.find(query, AUDIT_PROJECTION).sort('_id', 1).batch_size(self.batch_size):
+            batch.append(record)
+            if len(batch) == self.batch_size:
+                await self.process(batch, totals)
+                batch = []
+        if batch:
+            await self.process(batch, totals)
+        logger.info("Reconciled %s audit records in %s batches, %s breaks found",
+                    totals['records'], totals['batches'], totals['breaks'])
+        return totals
+
+    async def oldest_pending_id(self):
+        # The range bound lets the multikey index skip every user whose outbox is empty
+        pending = set()
+        async for user in self.users.find({f'{OUTBOX_FIELD}._id': {'$gte': LOWEST_OBJECT_ID}}, {OUTBOX_FIELD: 1}):
+            pending.update(entry['_id'] for entry in user[OUTBOX_FIELD])
+        if not pending:
+            return None
+        # An entry whose record is already stored only missed its outbox cleanup; it must not hold the run back
+        async for record in self.audit.find({'_id': {'$in': list(pending)}}, {'_id': 1}):
+            pending.discard(record['_id'])
+        return min(pending, default=None)
+
+    async def process(self, batch, totals):
+        applied_through = batch[-1]['_id']
+        chat_ids = list({record['chat_id'] for record in batch})
+        accounts = {account['_id']: account
+                    for account in await self.accounts.find({'_id': {'$in': chat_ids}}).to_list()}
+
+        # Records at or before an account's last batch were applied by a run that stopped before its checkpoint
+        records = [record for record in batch
+                   if record['chat_id'] not in accounts or record['_id'] > accounts[record['chat_id']]['applied_through']]
+        records.sort(key=lambda record: (record['chat_id'], record['timestamp'], record['_id']))
+        opening_balances = {chat_id: account['balance'] for chat_id, account in accounts.items()}
+        analyze_batch = analyze_vectorized if self.vectorized else analyze
+        if records:
+            changes, snapshots, breaks = analyze_batch(records, opening_balances)
+        else:
+            changes, snapshots, breaks = {}, {}, []
+        breaks += await self.check_balances(changes, applied_through)
+
+        # Snapshots are written before accounts, so a crash in between leaves snapshots ahead of their account
+        snapshot_ids = list({snapshot_id(record) for record in records})
+        applied = {snapshot['_id']: snapshot['applied_through'] for snapshot in await self.snapshots.find(
+            {'_id': {'$in': snapshot_ids}}, {'applied_through': 1}).to_list()}
+        snapshot_records = [record for record in records
+                            if snapshot_id(record) not in applied or record['_id'] > applied[snapshot_id(record)]]
+        if len(snapshot_records) < len(records):
+            snapshots = analyze_batch(snapshot_records, opening_balances)[1] if snapshot_records else {}
+
+        await write_once(self.snapshots, [
+            UpdateOne({'_id': f"{chat_id}:{day:%Y-%m-%d}", 'applied_through': {'$lt': applied_through}}, {
+                '$setOnInsert': {'chat_id': chat_id, 'day': day, 'opening_balance': snapshot['opening_balance']},
+                '$set': {'closing_balance': snapshot['closing_balance'], 'applied_through': applied_through},
+                '$inc': {'deposits': snapshot['deposits'], 'withdrawals': snapshot['withdrawals'],
+                         'transactions': snapshot['transactions']}}, upsert=True)
+            for (chat_id, day), snapshot in snapshots.items()])
+        await write_once(self.accounts, [
+            UpdateOne({'_id': chat_id, 'applied_through': {'$lt': applied_through}}, {
+                '$set': {'balance': change['balance'], 'last_timestamp': change['last_timestamp'],
+                         'applied_through': applied_through},
+                '$inc': {'deposits': change['deposits'], 'withdrawals': change['withdrawals'],
+                         'transactions': change['transactions'], 'breaks': change['breaks']}}, upsert=True)
+            for chat_id, change in changes.items()])
+        if breaks:
+            for entry in breaks:
+                logger.warning("Reconciliation break (%s) for chat %s: expected %s, found %s",
+                               entry['kind'], entry['chat_id'], entry['expected'], entry['found'])
+            await insert_once(self.breaks, breaks)
+        await self.checkpoints.update_one({'_id': CHECKPOINT_ID}, {
+            '$set': {'last_id': applied_through, 'updated_at': datetime.now()},
+            '$inc': {'records': len(records)}}, upsert=True)
+
+        totals['records'] += len(records)
+        totals['batches'] += 1
+        totals['breaks'] += len(breaks)
+
+    async def check_balances(self, changes, applied_through):
+        breaks = []
+        if not changes:
+            return breaks
+        users = {user['_id']: user for user in await self.users.find(
+            {'_id': {'$in': list(changes)}}, {'balance': 1, OUTBOX_FIELD: 1}).to_list()}
+        for chat_id, change in changes.items():
+            user = users.get(chat_id)
+            if user and (user.get(OUTBOX_FIELD) or abs(user['balance'] - change['balance']) <= TOLERANCE):
+                continue
+            # A balance that moved on after this batch is settled by a later run, not a break
+            if user and await self.audit.find_one({'chat_id': chat_id, '_id': {'$gt': applied_through}}, {'_id': 1}):
+                continue
+            change['breaks'] += 1
+            breaks.append({'_id': f"balance:{chat_id}:{applied_through}", 'chat_id': chat_id, 'audit_id': None,
+                           'kind': 'balance', 'expected': change['balance'],
+                           'found': user['balance'] if user else None, 'timestamp': change['last_timestamp']})
+        return breaks
+
+
+async def write_once(collection, requests):
+    # A document already updated by this batch fails the applied_through filter, and its upsert hits the existing _id
+    if requests:
+        try:
+            await collection.bulk_write(requests, ordered=False)
+        except BulkWriteError as e:
+            if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+                raise
+
+
+async def insert_once(collection, documents):
+    try:
+        await collection.insert_many(documents, ordered=False)
+    except BulkWriteError as e:
+        if any(error['code'] != DUPLICATE_KEY_ERROR for error in e.details['writeErrors']):
+            raise
+
+
+async def export_statement(audit, output, start, end, chat_id=None, batch_size=1000):
+    """Streams the audit records with `start <= timestamp < end` to `output` as CSV, one batch in memory at a time."""
+    query = {'timestamp': {'$gte': start, '$lt': end}}
+    if chat_id is not None:
+        query['chat_id'] = chat_id
+    writer = csv.writer(output)
+    writer.writerow(STATEMENT_COLUMNS)
+    rows = 0
+    # The exact reverse of the (chat_id, timestamp, _id) index, so the sort streams from the index
+    cursor = audit.find(query, AUDIT_PROJECTION).sort([('chat_id', -1), ('timestamp', 1), ('_id', 1)]).batch_size(batch_size)
+    async for record in cursor:
+        writer.writerow([record['timestamp'].isoformat(sep=' '), record['chat_id'], record['operation_type'],
+                         f"{record['amount']:.2f}", f"{record['previous_balance']:.2f}",
+                         f"{record['current_balance']:.2f}", str(record['_id'])])
+        rows += 1
+    return rows
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Reconcile balances against the audit trail and export statements.")
+    commands = parser.add_subparsers(dest='command', required=True)
+
+    run = commands.add_parser('run', help="check new audit records and update totals and daily snapshots")
+    run.add_argument('--batch-size', type=int, default=int(os.getenv('RECONCILE_BATCH_SIZE', '5000')))
+    run.add_argument('--settle-seconds', type=float, default=float(os.getenv('RECONCILE_SETTLE_SECONDS', '300')),
+                     help="leave records younger than this for the next run")
+    run.add_argument('--interval', type=float, help="keep running, every INTERVAL seconds")
+    run.add_argument('--rebuild', action='store_true', help="discard the reconciliation state and start over")
+    run.add_argument('--no-vectorize', action='store_true', help="do not use numpy even if it is installed")
+
+    export = commands.add_parser('export', help="write a CSV statement for a date range")
+    export.add_argument('--from', dest='start', required=True, type=datetime.fromisoformat, help="first day, YYYY-MM-DD")
+    export.add_argument('--to', dest='end', required=True, type=datetime.fromisoformat, help="last day, YYYY-MM-DD")
+    export.add_argument('--chat-id', type=int)
+    export.add_argument('--output', help="CSV file to write; standard output by default")
+    return parser.parse_args(argv)
+
+
+async def main(argv=None):
+    args = parse_args(argv)
+    client = AsyncMongoClient(os.getenv('MONGO_URI'))
+    db = client[os.getenv('DB_NAME')]
+    try:
+        if args.command == 'export':
+            end = args.end + timedelta(days=1)
+            if args.output:
+                with open(args.output, 'w', newline='') as output:
+                    rows = await export_statement(db['audit'], output, args.start, end, args.chat_id)
+            else:
+                rows = await export_statement(db['audit'], sys.stdout, args.start, end, args.chat_id)
+            logger.info("Exported %s transactions", rows)
+            return
+
+        reconciler = Reconciler(db, batch_size=args.batch_size, settle_seconds=args.settle_seconds,
+                                vectorized=False if args.no_vectorize else None)
+        if args.rebuild:
+            await reconciler.rebuild()
+        await reconciler.setup()
+        while True:
+            await reconciler.run()
+            if not args.interval:
+                break
+            await asyncio.sleep(args.interval)
+    finally:
+        await client.close()
+
+
+if __name__ == '__main__':
+    load_dotenv()
+    # Log to stderr so an exported statement can go to stdout
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    try:
+        asyncio.run(main())
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,25 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from audit_writer import AuditWriter
+from bench.memory_mongo import MemoryMongoClient
+from ledger import Ledger
+
+
+@pytest.fixture
+def db():
+    return MemoryMongoClient()['bank_bot_test']
+
+
+@pytest.fixture
+def audit_writer(db, tmp_path):
+    return AuditWriter(db['audit'], batch_size=10, spill_path=str(tmp_path / 'audit_spill.jsonl'))
+
+
+@pytest.fixture
+def ledger(db, audit_writer):
+    return Ledger(db['users'], audit_writer)
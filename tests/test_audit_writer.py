@@ -0,0 +1,86 @@
+import asyncio
+
+from pymongo.errors import AutoReconnect, BulkWriteError
+
+from ledger import OUTBOX_FIELD
+
+
+async def open_account(users, chat_id, balance):
+    await users.insert_one({'_id': chat_id, 'balance': balance})
+
+
+async def unreachable(*args, **kwargs):
+    raise AutoReconnect('connection refused')
+
+
+def test_outbox_is_cleared_once_records_are_flushed(db, ledger, audit_writer):
+    async def scenario():
+        for chat_id in (1, 2):
+            await open_account(db['users'], chat_id, 0.0)
+            await ledger.deposit(chat_id, 50.0)
+        await ledger.withdraw(1, 20.0)
+        pending = await db['users'].count_documents({f'{OUTBOX_FIELD}.0': {'$exists': True}})
+        await audit_writer.flush()
+        users = await db['users'].find({}).to_list()
+        return pending, users, await db['audit'].count_documents({})
+
+    pending, users, audited = asyncio.run(scenario())
+    assert pending == 2
+    assert audited == 3
+    assert all(user[OUTBOX_FIELD] == [] for user in users)
+
+
+def test_outbox_is_kept_until_spilled_records_are_replayed(db, ledger, audit_writer, monkeypatch):
+    async def scenario():
+        await open_account(db['users'], 1, 0.0)
+        await ledger.deposit(1, 10.0)
+        with monkeypatch.context() as patch:
+            patch.setattr(db['audit'], 'insert_many', unreachable)
+            await audit_writer.flush()
+        held = (await db['users'].find_one({'_id': 1}))[OUTBOX_FIELD]
+        await audit_writer.flush()
+        return held, await db['users'].find_one({'_id': 1}), await db['audit'].count_documents({})
+
+    held, user, audited = asyncio.run(scenario())
+    assert len(held) == 1
+    assert user[OUTBOX_FIELD] == []
+    assert audited == 1
+
+
+def test_refused_records_leave_the_outbox(db, ledger, audit_writer, monkeypatch):
+    insert_many = db['audit'].insert_many
+
+    async def refuse_first(records, ordered=True):
+        await insert_many(records[1:], ordered=ordered)
+        raise BulkWriteError({'writeErrors': [{'index': 0, 'code': 121, 'errmsg': 'Document failed validation'}],
+                              'writeConcernErrors': []})
+
+    async def scenario():
+        await open_account(db['users'], 1, 0.0)
+        await ledger.deposit(1, 10.0)
+        await ledger.deposit(1, 5.0)
+        monkeypatch.setattr(db['audit'], 'insert_many', refuse_first)
+        await audit_writer.flush()
+        return await db['users'].find_one({'_id': 1}), await db['audit'].count_documents({})
+
+    user, audited = asyncio.run(scenario())
+    assert user[OUTBOX_FIELD] == []
+    assert audited == 1
+    with open(audit_writer.rejected_path) as rejected_file:
+        assert len(rejected_file.readlines()) == 1
+
+
+def test_failed_outbox_cleanup_is_retried_on_the_next_flush(db, ledger, audit_writer, monkeypatch):
+    async def scenario():
+        await open_account(db['users'], 1, 0.0)
+        await ledger.deposit(1, 10.0)
+        with monkeypatch.context() as patch:
+            patch.setattr(db['users'], 'bulk_write', unreachable)
+            await audit_writer.flush()
+        held = (await db['users'].find_one({'_id': 1}))[OUTBOX_FIELD]
+        await audit_writer.flush()
+        return held, await db['users'].find_one({'_id': 1})
+
+    held, user = asyncio.run(scenario())
+    assert len(held) == 1
+    assert user[OUTBOX_FIELD] == []
@@ -0,0 +1,80 @@
+import asyncio
+from types import SimpleNamespace
+
+from dispatcher import ChatDispatcher, get_update_chat_id
+
+
+def make_update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)),
+                           edited_message=None, callback_query=None)
+
+
+def test_updates_of_a_chat_run_in_order_and_chats_run_concurrently():
+    processed = []
+    running = set()
+    overlapped = []
+
+    async def process_update(update):
+        chat_id = get_update_chat_id(update)
+        assert chat_id not in running
+        running.add(chat_id)
+        overlapped.append(len(running))
+        # Later updates of chat 1 finish first if the chat is not serialized
+        await asyncio.sleep(0.03 if update.update_id < 3 else 0.001)
+        processed.append((chat_id, update.update_id))
+        running.discard(chat_id)
+
+    async def scenario():
+        dispatcher = ChatDispatcher(process_update, max_workers=10)
+        for update_id, chat_id in enumerate([1, 2, 1, 1, 2]):
+            assert dispatcher.submit(make_update(update_id, chat_id))
+        await dispatcher.drain(5)
+        return dispatcher.stats()
+
+    stats = asyncio.run(scenario())
+    assert [update_id for chat_id, update_id in processed if chat_id == 1] == [0, 2, 3]
+    assert [update_id for chat_id, update_id in processed if chat_id == 2] == [1, 4]
+    assert max(overlapped) == 2
+    assert (stats['processed'], stats['pending'], stats['active_chats']) == (5, 0, 0)
+
+
+def test_full_dispatcher_refuses_updates_until_one_finishes():
+    release = asyncio.Event()
+
+    async def process_update(update):
+        await release.wait()
+
+    async def scenario():
+        dispatcher = ChatDispatcher(process_update, max_pending=2)
+        accepted = [dispatcher.submit(make_update(update_id, update_id)) for update_id in range(3)]
+        full = not dispatcher.has_capacity.is_set()
+        release.set()
+        async with asyncio.timeout(5):
+            await dispatcher.has_capacity.wait()
+        await dispatcher.drain(5)
+        return accepted, full, dispatcher.stats()
+
+    accepted, full, stats = asyncio.run(scenario())
+    assert accepted == [True, True, False]
+    assert full
+    assert (stats['received'], stats['rejected'], stats['processed']) == (2, 1, 2)
+
+
+def test_failing_update_does_not_stop_its_chat():
+    processed = []
+
+    async def process_update(update):
+        if update.update_id == 0:
+            raise RuntimeError('handler failed')
+        processed.append(update.update_id)
+
+    async def scenario():
+        dispatcher = ChatDispatcher(process_update)
+        dispatcher.submit(make_update(0, 1))
+        dispatcher.submit(make_update(1, 1))
+        await dispatcher.drain(5)
+        return dispatcher.stats()
+
+    stats = asyncio.run(scenario())
+    assert processed == [1]
+    assert (stats['failed'], stats['processed']) == (1, 1)
@@ -0,0 +1,106 @@
+import asyncio
+from datetime import datetime, timedelta
+from types import SimpleNamespace
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+import bot
+
+
+@pytest.fixture
+def replies(db, audit_writer, monkeypatch):
+    sent = []
+    monkeypatch.setattr(bot, 'users', db['users'])
+    monkeypatch.setattr(bot, 'audit', db['audit'])
+    monkeypatch.setattr(bot, 'audit_writer', audit_writer)
+    monkeypatch.setattr(bot.sender, 'send', lambda chat_id, text, **kwargs: sent.append((text, kwargs)))
+    return sent
+
+
+def show(direction=None, cursor=None):
+    return bot.show_history(SimpleNamespace(chat=SimpleNamespace(id=1)), direction, cursor)
+
+
+def shown_balances(text):
+    return [float(line.rsplit('$', 1)[1]) for line in text.splitlines() if line.startswith('Previous balance')]
+
+
+async def deposit(db, ledger, count):
+    if not await db['users'].find_one({'_id': 1}):
+        await db['users'].insert_one({'_id': 1, 'balance': 0.0})
+    for _ in range(count):
+        await ledger.deposit(1, 1.0)
+
+
+def test_transactions_show_up_before_they_are_stored(db, ledger, audit_writer, replies):
+    async def scenario():
+        await deposit(db, ledger, 10)
+        await audit_writer.flush()
+        await deposit(db, ledger, 2)
+        await show()
+
+    asyncio.run(scenario())
+    assert shown_balances(replies[0][0]) == [12.0, 11.0, 10.0, 9.0, 8.0, 7.0, 6.0, 5.0, 4.0, 3.0]
+
+
+def test_spilled_transactions_are_read_from_the_outbox(db, ledger, audit_writer, replies, monkeypatch):
+    async def unreachable(*args, **kwargs):
+        raise AutoReconnect('connection refused')
+
+    async def scenario():
+        await deposit(db, ledger, 3)
+        with monkeypatch.context() as patch:
+            patch.setattr(db['audit'], 'insert_many', unreachable)
+            await audit_writer.flush()
+        await show()
+
+    asyncio.run(scenario())
+    assert audit_writer.buffer == []
+    assert shown_balances(replies[0][0]) == [3.0, 2.0, 1.0]
+
+
+def test_history_cursor_round_trips():
+    transaction = {'_id': ObjectId(), 'timestamp': datetime(2024, 5, 1, 12, 30, 15, 123000)}
+    cursor = bot.encode_history_cursor(transaction)
+    assert bot.decode_history_cursor(cursor) == (transaction['timestamp'], transaction['_id'])
+    # Callback data is limited to 64 bytes
+    assert len(f'history_older_{cursor}'.encode()) <= 64
+
+
+def button_data(kwargs, label):
+    return next(button.callback_data for row in kwargs['reply_markup'].keyboard for button in row if button.text == label)
+
+
+def has_button(kwargs, label):
+    return any(button.text == label for row in kwargs['reply_markup'].keyboard for button in row)
+
+
+def test_pages_walk_older_and_back_newer_without_gaps(db, replies):
+    start = datetime(2024, 5, 1, 12, 0)
+    # Pairs of transactions share a timestamp, so pages must break ties on _id
+    transactions = [{'_id': ObjectId(), 'chat_id': 1, 'operation_type': 'deposit', 'amount': 1.0,
+                     'previous_balance': float(index), 'current_balance': float(index + 1),
+                     'timestamp': start + timedelta(minutes=index // 2)} for index in range(25)]
+
+    async def scenario():
+        await db['audit'].insert_many(transactions)
+        await show()
+        pages = [replies[-1]]
+        while has_button(pages[-1][1], 'Older'):
+            _, direction, cursor = button_data(pages[-1][1], 'Older').split('_', 2)
+            await show(direction, cursor)
+            pages.append(replies[-1])
+        _, direction, cursor = button_data(pages[-1][1], 'Newer').split('_', 2)
+        await show(direction, cursor)
+        return pages, replies[-1]
+
+    pages, back = asyncio.run(scenario())
+    assert [shown_balances(text) for text, _ in pages] == [
+        [float(balance) for balance in range(25, 15, -1)],
+        [float(balance) for balance in range(15, 5, -1)],
+        [float(balance) for balance in range(5, 0, -1)]]
+    assert not has_button(pages[0][1], 'Newer')
+    assert shown_balances(back[0]) == shown_balances(pages[1][0])
+    assert has_button(back[1], 'Newer') and has_button(back[1], 'Older')
@@ -0,0 +1,31 @@
+import asyncio
+
+
+async def open_account(users, chat_id, balance):
+    await users.insert_one({'_id': chat_id, 'balance': balance})
+
+
+def test_concurrent_withdrawals_cannot_overdraw(db, ledger):
+    async def scenario():
+        await open_account(db['users'], 1, 100.0)
+        results = await asyncio.gather(*(ledger.withdraw(1, 30.0) for _ in range(10)))
+        return results, await db['users'].find_one({'_id': 1})
+
+    results, user = asyncio.run(scenario())
+    accepted = [entry for entry in results if entry is not None]
+    assert len(accepted) == 3
+    assert user['balance'] == 10.0
+    assert sorted(entry['previous_balance'] for entry in accepted) == [40.0, 70.0, 100.0]
+    assert all(entry['current_balance'] == entry['previous_balance'] - 30.0 for entry in accepted)
+
+
+def test_withdrawal_above_balance_changes_nothing(db, ledger, audit_writer):
+    async def scenario():
+        await open_account(db['users'], 1, 20.0)
+        entry = await ledger.withdraw(1, 20.01)
+        return entry, await db['users'].find_one({'_id': 1})
+
+    entry, user = asyncio.run(scenario())
+    assert entry is None
+    assert user == {'_id': 1, 'balance': 20.0}
+    assert audit_writer.buffer == []
@@ -0,0 +1,80 @@
+import asyncio
+import time
+
+from telebot.asyncio_helper import ApiTelegramException
+
+from message_sender import PRIORITY_TRANSACTION, MessageSender, TokenBucket
+
+
+class FakeBot:
+    def __init__(self, failures=()):
+        self.sent = []
+        self.failures = list(failures)
+        self.started = time.monotonic()
+
+    async def send_message(self, chat_id, text, **kwargs):
+        if self.failures:
+            raise self.failures.pop(0)
+        self.sent.append((chat_id, text, time.monotonic() - self.started))
+
+
+def too_many_requests(retry_after):
+    return ApiTelegramException('sendMessage', None, {'ok': False, 'error_code': 429, 'description': 'Too Many Requests',
+                                                      'parameters': {'retry_after': retry_after}})
+
+
+async def deliver_all(sender, timeout=5):
+    sender.start()
+    await sender.close(timeout)
+
+
+def test_token_bucket_allows_a_burst_then_the_rate():
+    bucket = TokenBucket(rate=2, capacity=3)
+    now = bucket.updated_at
+    for _ in range(3):
+        assert bucket.wait_time(now) == 0
+        bucket.consume()
+    assert bucket.wait_time(now) == 0.5
+    assert bucket.wait_time(now + 0.5) == 0
+    assert not bucket.is_full(now + 0.5)
+    assert bucket.is_full(now + 10)
+
+
+def test_chat_messages_keep_their_order_within_the_chat_rate():
+    bot = FakeBot()
+    sender = MessageSender(bot, global_rate=1000, chat_rate=10, chat_burst=2)
+    for index in range(5):
+        sender.send(1, f'message {index}')
+    asyncio.run(deliver_all(sender))
+
+    assert [text for _, text, _ in bot.sent] == [f'message {index}' for index in range(5)]
+    times = [sent_at for _, _, sent_at in bot.sent]
+    # Two go out at once, the rest one per 1/chat_rate seconds
+    assert times[1] < 0.05
+    assert times[4] >= 0.25
+    assert sender.stats()['sent'] == 5
+
+
+def test_rate_limited_message_is_retried_after_retry_after():
+    bot = FakeBot(failures=[too_many_requests(0.3)])
+    sender = MessageSender(bot, global_rate=1000, chat_rate=100, chat_burst=10)
+    sender.send(1, 'first')
+    sender.send(1, 'second')
+    asyncio.run(deliver_all(sender))
+
+    assert [text for _, text, _ in bot.sent] == ['first', 'second']
+    assert bot.sent[0][2] >= 0.3
+    stats = sender.stats()
+    assert (stats['rate_limited'], stats['sent'], stats['failed']) == (1, 2, 0)
+
+
+def test_transaction_messages_go_out_first():
+    bot = FakeBot()
+    sender = MessageSender(bot, global_rate=1000, max_concurrency=1)
+    sender.send(1, 'menu')
+    sender.send(2, 'prompt')
+    sender.send(3, 'confirmation', priority=PRIORITY_TRANSACTION)
+    asyncio.run(deliver_all(sender))
+
+    assert [chat_id for chat_id, _, _ in bot.sent] == [3, 1, 2]
+
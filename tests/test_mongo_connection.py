@@ -0,0 +1,101 @@
+import asyncio
+
+from pymongo.errors import ServerSelectionTimeoutError
+
+from bench.memory_mongo import MemoryMongoClient
+from mongo_connection import CLOSED, HALF_OPEN, OPEN, MongoConnectionManager
+
+
+class FlakyClient(MemoryMongoClient):
+    """Fails pings while `down` is set."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.down = False
+        ping = self.admin.command
+
+        async def command(name, *args, **kwargs):
+            if self.down:
+                raise ServerSelectionTimeoutError('no servers available')
+            return await ping(name, *args, **kwargs)
+
+        self.admin.command = command
+
+
+def make_manager(setup=None):
+    return MongoConnectionManager('mongodb://test', 'bank_bot_test', setup=setup, probe_interval=3600,
+                                  failure_threshold=2, client_factory=FlakyClient)
+
+
+async def start(manager):
+    # The background task probes once right away, then sleeps for probe_interval
+    manager.start()
+    while not manager.ready and not manager.failures:
+        await asyncio.sleep(0)
+
+
+def test_breaker_opens_after_the_threshold_and_recovers_through_half_open():
+    async def scenario():
+        manager = make_manager()
+        await start(manager)
+        states = []
+        try:
+            states.append((manager.state, manager.available))
+            manager.client.down = True
+            for _ in range(2):
+                await manager.probe()
+                states.append((manager.state, manager.available))
+            manager.client.down = False
+            for _ in range(2):
+                await manager.probe()
+                states.append((manager.state, manager.available))
+            return states, manager.stats()
+        finally:
+            await manager.close()
+
+    states, stats = asyncio.run(scenario())
+    assert states == [(CLOSED, True), (CLOSED, True), (OPEN, False), (HALF_OPEN, True), (CLOSED, True)]
+    assert stats['trips'] == 1
+
+
+def test_failure_while_half_open_opens_the_breaker_again():
+    async def scenario():
+        manager = make_manager()
+        await start(manager)
+        try:
+            manager.client.down = True
+            await manager.probe()
+            await manager.probe()
+            manager.client.down = False
+            await manager.probe()
+            manager.client.down = True
+            await manager.probe()
+            return manager.state, manager.stats()['trips']
+        finally:
+            await manager.close()
+
+    assert asyncio.run(scenario()) == (OPEN, 2)
+
+
+def test_unavailable_until_setup_succeeds():
+    calls = []
+
+    async def setup(db):
+        calls.append(db.name)
+        if len(calls) == 1:
+            raise ServerSelectionTimeoutError('not primary')
+
+    async def scenario():
+        manager = make_manager(setup)
+        await start(manager)
+        try:
+            first = manager.available
+            await manager.probe()
+            await manager.probe()
+            return first, manager.available
+        finally:
+            await manager.close()
+
+    assert asyncio.run(scenario()) == (False, True)
+    # Setup runs again only until it has succeeded once
+    assert calls == ['bank_bot_test', 'bank_bot_test']
@@ -0,0 +1,144 @@
+import asyncio
+import random
+from datetime import datetime, timedelta
+
+import pytest
+from bson import ObjectId
+from pymongo.errors import AutoReconnect
+
+from ledger import OUTBOX_FIELD
+from reconciliation import Reconciler, analyze, analyze_vectorized, np
+
+
+def make_records(seed, chats=20, per_chat=30, break_rate=0.05):
+    """Sorted audit records over a few days, with some chain and amount breaks mixed in."""
+    rng = random.Random(seed)
+    start = datetime(2024, 3, 1, 9, 0)
+    records = []
+    for chat_id in range(1, chats + 1):
+        balance = 0.0
+        timestamp = start
+        for _ in range(rng.randint(1, per_chat)):
+            timestamp += timedelta(hours=rng.randint(1, 20))
+            operation_type = 'deposit' if balance < 50 or rng.random() < 0.6 else 'withdrawal'
+            amount = round(rng.uniform(1, 50), 2)
+            previous = balance
+            current = previous + amount if operation_type == 'deposit' else previous - amount
+            if rng.random() < break_rate:
+                previous += 1.0
+            if rng.random() < break_rate:
+                current += 0.5
+            records.append({'_id': ObjectId(), 'chat_id': chat_id, 'operation_type': operation_type,
+                            'amount': amount, 'previous_balance': previous, 'current_balance': current,
+                            'timestamp': timestamp})
+            balance = current
+    return records
+
+
+def assert_close(python, vectorized):
+    assert python.keys() == vectorized.keys()
+    for key, values in python.items():
+        assert values.keys() == vectorized[key].keys()
+        for field, value in values.items():
+            if isinstance(value, float):
+                assert vectorized[key][field] == pytest.approx(value), (key, field)
+            else:
+                assert vectorized[key][field] == value, (key, field)
+
+
+@pytest.mark.skipif(np is None, reason="numpy is not installed")
+@pytest.mark.parametrize('seed', range(5))
+def test_vectorized_analysis_matches_python(seed):
+    records = make_records(seed)
+    opening_balances = {chat_id: 0.0 for chat_id in range(1, 21, 2)}
+    opening_balances[3] = 5.0
+
+    accounts, snapshots, breaks = analyze(records, opening_balances)
+    vectorized_accounts, vectorized_snapshots, vectorized_breaks = analyze_vectorized(records, opening_balances)
+
+    assert breaks
+    assert_close(accounts, vectorized_accounts)
+    assert_close(snapshots, vectorized_snapshots)
+    assert [(b['_id'], b['kind']) for b in breaks] == [(b['_id'], b['kind']) for b in vectorized_breaks]
+    for python_break, vectorized_break in zip(breaks, vectorized_breaks):
+        assert vectorized_break['expected'] == pytest.approx(python_break['expected'])
+        assert vectorized_break['found'] == pytest.approx(python_break['found'])
+
+
+def test_clean_chain_has_no_breaks():
+    records = make_records(7, break_rate=0)
+    accounts, _, breaks = analyze(records, {})
+    assert breaks == []
+    assert all(account['breaks'] == 0 for account in accounts.values())
+    assert sum(account['transactions'] for account in accounts.values()) == len(records)
+
+
+def audit_ids(start, count):
+    first = int(str(ObjectId.from_datetime(start)), 16)
+    return [ObjectId(f'{first + index:024x}') for index in range(count)]
+
+
+async def add_deposits(db, chat_id, amounts, start):
+    user = await db['users'].find_one({'_id': chat_id}) or {'_id': chat_id, 'balance': 0.0}
+    balance = user['balance']
+    for _id, amount in zip(audit_ids(start, len(amounts)), amounts):
+        await db['audit'].insert_one({'_id': _id, 'chat_id': chat_id, 'operation_type': 'deposit', 'amount': amount,
+                                      'previous_balance': balance, 'current_balance': balance + amount,
+                                      'timestamp': start})
+        balance += amount
+    await db['users'].replace_one({'_id': chat_id}, {'_id': chat_id, 'balance': balance}, upsert=True)
+
+
+def test_rerun_after_a_crash_between_snapshot_and_account_writes_counts_once(db, monkeypatch):
+    reconciler = Reconciler(db, batch_size=100, settle_seconds=0, vectorized=False)
+    accounts_bulk_write = db['reconciliation_accounts'].bulk_write
+    day = datetime.now() - timedelta(minutes=5)
+
+    async def crash_once(*args, **kwargs):
+        monkeypatch.setattr(db['reconciliation_accounts'], 'bulk_write', accounts_bulk_write)
+        raise AutoReconnect('connection reset')
+
+    async def scenario():
+        await add_deposits(db, 1, [10.0, 10.0, 10.0], day)
+        monkeypatch.setattr(db['reconciliation_accounts'], 'bulk_write', crash_once)
+        with pytest.raises(AutoReconnect):
+            await reconciler.run()
+        await add_deposits(db, 2, [5.0], day + timedelta(seconds=1))
+        totals = await reconciler.run()
+        again = await reconciler.run()
+        snapshot = await db['balance_snapshots'].find_one({'_id': f'1:{day:%Y-%m-%d}'})
+        account = await db['reconciliation_accounts'].find_one({'_id': 1})
+        return totals, again, snapshot, account
+
+    totals, again, snapshot, account = asyncio.run(scenario())
+    assert totals['breaks'] == 0
+    assert again['records'] == 0
+    assert (snapshot['transactions'], snapshot['deposits'], snapshot['closing_balance']) == (3, 30.0, 30.0)
+    assert (account['transactions'], account['deposits'], account['balance']) == (3, 30.0, 30.0)
+
+
+def test_outbox_entries_already_stored_do_not_hold_the_run_back(db):
+    reconciler = Reconciler(db, batch_size=100, settle_seconds=0, vectorized=False)
+    day = datetime.now() - timedelta(minutes=5)
+
+    async def scenario():
+        await add_deposits(db, 1, [10.0, 10.0], day)
+        # The outbox cleanup of a stored record failed, so the entry is still there
+        stored = await db['audit'].find_one({'chat_id': 1})
+        await db['users'].update_one({'_id': 1}, {'$set': {OUTBOX_FIELD: [stored]}})
+        first = await reconciler.run()
+        # A record still on its way to the audit collection does stop the run
+        await add_deposits(db, 2, [5.0, 5.0], day + timedelta(seconds=1))
+        unwritten = await db['audit'].find_one_and_delete({'chat_id': 2, 'previous_balance': 5.0})
+        await db['users'].update_one({'_id': 2}, {'$set': {OUTBOX_FIELD: [unwritten]}})
+        second = await reconciler.run()
+        await db['audit'].insert_one(unwritten)
+        await db['users'].update_one({'_id': 2}, {'$set': {OUTBOX_FIELD: []}})
+        third = await reconciler.run()
+        return first, second, third
+
+    first, second, third = asyncio.run(scenario())
+    assert first['records'] == 2
+    assert second['records'] == 1
+    assert third['records'] == 1
+    assert third['breaks'] == 0
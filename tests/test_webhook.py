@@ -0,0 +1,40 @@
+import asyncio
+import json
+
+import pytest
+from aiohttp.test_utils import TestClient, TestServer
+
+from dispatcher import ChatDispatcher
+from webhook import create_webhook_app
+
+
+async def post_updates(bodies, max_pending=10):
+    # Updates stay pending until every body is posted
+    release = asyncio.Event()
+
+    async def process_update(update):
+        await release.wait()
+
+    dispatcher = ChatDispatcher(process_update, max_pending=max_pending)
+    async with TestClient(TestServer(create_webhook_app(dispatcher))) as client:
+        statuses = []
+        for body in bodies:
+            response = await client.post('/webhook', data=body, headers={'Content-Type': 'application/json'})
+            statuses.append(response.status)
+    release.set()
+    await dispatcher.drain(5)
+    return statuses
+
+
+def update(update_id, chat_id=1):
+    return json.dumps({'update_id': update_id, 'message': {'message_id': update_id, 'date': 0, 'text': '/start',
+                                                           'chat': {'id': chat_id, 'type': 'private'}}})
+
+
+@pytest.mark.parametrize('body', ['null', '[]', '1', '"update"', '{}', '{"update_id":', ''])
+def test_malformed_updates_are_answered_400(body):
+    assert asyncio.run(post_updates([body])) == [400]
+
+
+def test_full_queue_is_answered_503():
+    assert asyncio.run(post_updates([update(1), update(2), update(3)], max_pending=2)) == [200, 200, 503]
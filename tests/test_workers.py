@@ -0,0 +1,44 @@
+import asyncio
+import time
+from types import SimpleNamespace
+
+import workers
+from workers import PartitionedDispatcher
+
+
+def exit_at_once(index, connection):
+    pass
+
+
+def make_update(update_id, chat_id):
+    return SimpleNamespace(update_id=update_id, message=SimpleNamespace(chat=SimpleNamespace(id=chat_id)),
+                           edited_message=None, callback_query=None)
+
+
+async def wait_until(condition, timeout=10):
+    async with asyncio.timeout(timeout):
+        while not condition():
+            await asyncio.sleep(0.05)
+
+
+def test_polling_pauses_until_a_crashed_worker_can_be_restarted(monkeypatch):
+    monkeypatch.setattr(workers, 'RESTART_DELAY', 1.0)
+
+    async def scenario():
+        dispatcher = PartitionedDispatcher(1, exit_at_once)
+        try:
+            await wait_until(lambda: not dispatcher.workers[0].process.is_alive())
+            refused = dispatcher.submit(make_update(1, 1))
+            paused = not dispatcher.has_capacity.is_set()
+            started = time.monotonic()
+            async with asyncio.timeout(10):
+                await dispatcher.has_capacity.wait()
+            return refused, paused, time.monotonic() - started, dispatcher.restarts
+        finally:
+            await dispatcher.drain(5)
+
+    refused, paused, waited, restarts = asyncio.run(scenario())
+    assert refused is False
+    assert paused
+    assert waited > 0.1
+    assert restarts == 1
@@ -0,0 +1,56 @@
+import asyncio
+import json
+import logging
+from aiohttp import web
+from telebot import types
+from metrics import show_metrics
+
+
+logger = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+def create_webhook_app(dispatcher, path='/webhook', secret_token=None):
+    async def receive_update(request):
+        if secret_token and request.headers.get(SECRET_TOKEN_HEADER) != secret_token:
+            return web.Response(status=403)
+
+        try:
+            update = types.Update.de_json(await request.text())
+        except (ValueError, KeyError, TypeError) as e:
+            # TypeError: valid JSON that is not an object, such as null or []
+            logger.warning("Discarding malformed update: %s", e)
+            return web.Response(status=400)
+
+        if not dispatcher.submit(update):
+            # Telegram retries non-2xx deliveries, so a full queue pushes back on the sender
+            logger.warning("Update queue full, rejecting update %s", update.update_id)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def show_stats(request):
+        return web.json_response(dispatcher.stats())
+
+    app = web.Application()
+    app.router.add_post(path, receive_update)
+    app.router.add_get('/stats', show_stats)
+    app.router.add_get('/metrics', show_metrics)
+    return app
+
+
+async def run_webhook(bot, dispatcher, host, port, path='/webhook', public_url=None, secret_token=None):
+    runner = web.AppRunner(create_webhook_app(dispatcher, path, secret_token))
+    await runner.setup()
+    site = web.TCPSite(runner, host, port)
+    await site.start()
+    logger.info("Webhook server listening on %s:%s%s", host, port, path)
+
+    try:
+        if public_url:
+            await bot.set_webhook(url=public_url.rstrip('/') + path, secret_token=secret_token)
+            logger.info("Webhook registered at %s", public_url)
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+        logger.info("Webhook server stopped: %s", json.dumps(dispatcher.stats()))
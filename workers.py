@@ -0,0 +1,197 @@
+import asyncio
+import logging
+import multiprocessing
+import time
+from concurrent.futures import ThreadPoolExecutor
+from dispatcher import get_update_chat_id
+
+
+logger = logging.getLogger(__name__)
+
+# A worker that dies sooner than this after starting is not restarted right away, so a crash loop cannot spin
+RESTART_DELAY = 5.0
+
+
+class WorkerProcess:
+    def __init__(self, context, index, target):
+        receiver, self.connection = context.Pipe(duplex=False)
+        self.process = context.Process(target=target, args=(index, receiver), name=f'bot-worker-{index}')
+        self.process.start()
+        self.started_at = time.monotonic()
+        receiver.close()
+        # A pipe write blocks while the worker is behind, so writes get a thread of their own
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'bot-worker-{index}-send')
+        self.pending = 0
+
+
+def stop_worker(connection):
+    try:
+        connection.send(None)
+    except OSError:
+        pass
+    finally:
+        connection.close()
+
+
+class PartitionedDispatcher:
+    """Spreads updates over worker processes by chat_id hash.
+
+    Every update of a chat goes to the same worker, which keeps the per-chat
+    ordering of `ChatDispatcher`. `worker_target(index, connection)` runs in each
+    child process and receives updates from `connection` until it gets None.
+    Updates are written to the pipes off the event loop. At most `max_pending`
+    unsent updates are held per worker; `submit` refuses updates beyond that.
+    A worker that dies is restarted, and updates that could not be sent to it
+    go to its replacement. While a worker that keeps crashing waits to be
+    restarted, its updates are refused. `has_capacity` is cleared while any
+    worker is full or waiting to be restarted, because long polling has to take
+    updates in order and cannot skip the refused ones.
+    """
+
+    def __init__(self, worker_count, worker_target, max_pending=1000, max_attempts=3):
+        self.worker_target = worker_target
+        self.max_pending = max_pending
+        self.max_attempts = max_attempts
+        # Spawned workers start from a clean interpreter instead of a copy of the running event loop
+        self.context = multiprocessing.get_context('spawn')
+        self.workers = [WorkerProcess(self.context, index, worker_target) for index in range(worker_count)]
+        self.submitted = [0] * worker_count
+        self.restarts = 0
+        self.lost = 0
+        self.closing = False
+        # Timers of dead workers that were restarted too recently to restart right away
+        self.restart_timers = {}
+        self.has_capacity = asyncio.Event()
+        self.has_capacity.set()
+        logger.info("Started %s worker processes", worker_count)
+
+    def submit(self, update):
+        key = get_update_chat_id(update)
+        if key is None:
+            key = update.update_id
+        index = hash(key) % len(self.workers)
+        if not self.workers[index].process.is_alive() and not self.revive(index):
+            return False
+        if self.workers[index].pending >= self.max_pending:
+            return False
+        self.send(index, update, 1)
+        self.submitted[index] += 1
+        return True
+
+    def send(self, index, update, attempt):
+        worker = self.workers[index]
+        worker.pending += 1
+        self.update_capacity()
+        future = asyncio.wrap_future(worker.executor.submit(worker.connection.send, update))
+        future.add_done_callback(lambda future: self.on_sent(index, worker, update, attempt, future))
+
+    def on_sent(self, index, worker, update, attempt, future):
+        worker.pending -= 1
+        error = None if future.cancelled() else future.exception()
+        if error is not None:
+            if worker is self.workers[index] and not self.closing:
+                logger.error("Worker %s is gone: %s", index, error)
+                self.revive(index)
+            if self.closing or attempt >= self.max_attempts or worker is self.workers[index]:
+                logger.error("Dropping update %s for worker %s: %s", update.update_id, index, error)
+                self.lost += 1
+            else:
+                # Callbacks run in send order, so resent updates keep their order
+                self.send(index, update, attempt + 1)
+        self.update_capacity()
+
+    def revive(self, index):
+        if index in self.restart_timers:
+            return False
+        if self.restart(index):
+            return True
+        # Polling stops until the worker is back, instead of fetching the refused update again and again
+        delay = RESTART_DELAY - (time.monotonic() - self.workers[index].started_at)
+        self.restart_timers[index] = asyncio.get_running_loop().call_later(delay, self.restart_later, index)
+        self.update_capacity()
+        return False
+
+    def restart_later(self, index):
+        del self.restart_timers[index]
+        if not self.closing and not self.workers[index].process.is_alive():
+            self.restart(index)
+        self.update_capacity()
+
+    def restart(self, index):
+        old = self.workers[index]
+        if time.monotonic() - old.started_at < RESTART_DELAY:
+            return False
+        self.workers[index] = WorkerProcess(self.context, index, self.worker_target)
+        self.restarts += 1
+        # Updates still queued for the old pipe fail there and are resent to the new worker
+        old.executor.submit(old.connection.close)
+        old.executor.shutdown(wait=False)
+        logger.warning("Restarted worker %s (exit code %s)", index, old.process.exitcode)
+        return True
+
+    def update_capacity(self):
+        if not self.restart_timers and all(worker.pending < self.max_pending for worker in self.workers):
+            self.has_capacity.set()
+        else:
+            self.has_capacity.clear()
+
+    async def drain(self, timeout=None):
+        self.closing = True
+        for timer in self.restart_timers.values():
+            timer.cancel()
+        self.restart_timers.clear()
+        for worker in self.workers:
+            worker.executor.submit(stop_worker, worker.connection)
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + timeout if timeout is not None else None
+        while any(worker.process.is_alive() for worker in self.workers):
+            if deadline is not None and loop.time() > deadline:
+                logger.warning("Worker processes did not stop in time, terminating them")
+                for worker in self.workers:
+                    worker.process.terminate()
+                break
+            await asyncio.sleep(0.1)
+        for worker in self.workers:
+            worker.executor.shutdown(wait=False)
+
+    def stats(self):
+        return {
+            'workers': len(self.workers),
+            'alive': sum(worker.process.is_alive() for worker in self.workers),
+            'submitted': list(self.submitted),
+            'pending': sum(worker.pending for worker in self.workers),
+            'restarts': self.restarts,
+            'lost': self.lost,
+        }
+
+
+async def receive_updates(connection, dispatcher):
+    """Feeds updates from the launcher's pipe into a local dispatcher until told to stop."""
+    loop = asyncio.get_running_loop()
+    stopped = loop.create_future()
+    tasks = set()
+
+    def on_readable():
+        try:
+            update = connection.recv()
+        except EOFError:
+            update = None
+        if update is None:
+            loop.remove_reader(connection.fileno())
+            if not stopped.done():
+                stopped.set_result(None)
+            return
+        dispatcher.submit(update)
+        if not dispatcher.has_capacity.is_set():
+            # Stop reading until the dispatcher has room; the pipe then pushes back on the launcher
+            loop.remove_reader(connection.fileno())
+            task = loop.create_task(resume_reading())
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+
+    async def resume_reading():
+        await dispatcher.has_capacity.wait()
+        loop.add_reader(connection.fileno(), on_readable)
+
+    loop.add_reader(connection.fileno(), on_readable)
+    await stopped